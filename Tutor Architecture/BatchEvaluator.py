@@ -0,0 +1,86 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+class JsonLinesWriter:
+    ''' Thread-safe, incremental JSON-lines output. Every record is flushed as soon as it is written so partial runs are never lost. '''
+    def __init__(self, path: str = None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.fh = None
+
+        if path is not None:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self.fh = open(path, "a")
+
+    def write(self, record: dict):
+        if self.fh is None:
+            return
+
+        with self.lock:
+            self.fh.write(json.dumps(record) + "\n")
+            self.fh.flush()
+
+    def close(self):
+        if self.fh is not None:
+            self.fh.close()
+            self.fh = None
+
+
+''' Accept either {'q': question, 'a': answer} dicts (the runme.py question bank format) or (question, answer) tuples '''
+def normalizePair(pair):
+    if isinstance(pair, dict):
+        return pair["q"], pair["a"]
+
+    question, answer = pair
+    return question, answer
+
+
+''' Rate every question-answer pair with every tutor. Retrieval and GPT calls for different (tutor, pair) jobs run concurrently on a bounded thread pool.
+    Returns {tutor name: [result for each pair, in input order]}. Each result is the dict returned by Tutor.answerRatingResult() plus the tutor name and
+    pair index; a job that fails records its error instead of aborting the whole batch. '''
+def evaluateTutors(tutors: dict, questionBank, maxWorkers: int = 8, outputPath: str = None):
+    pairs = [normalizePair(pair) for pair in questionBank]
+    results = {name: [None] * len(pairs) for name in tutors}
+
+    writer = JsonLinesWriter(outputPath)
+    try:
+        with ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+            futures = dict()
+            for name, tutor in tutors.items():
+                for index, (question, answer) in enumerate(pairs):
+                    futures[executor.submit(rateOne, tutor, question, answer)] = (name, index)
+
+            for future in as_completed(futures):
+                name, index = futures[future]
+
+                result = future.result()
+                result["tutor"] = name
+                result["index"] = index
+
+                results[name][index] = result
+                writer.write(result)
+    finally:
+        writer.close()
+
+    return results
+
+
+''' Run a single rating job, capturing failures as part of the result '''
+def rateOne(tutor, question, answer):
+    startTime = time.perf_counter()
+    try:
+        return tutor.answerRatingResult(question, answer)
+    except Exception as e:
+        return {"question": question,
+                "answer": answer,
+                "rating": None,
+                "feedback": None,
+                "retrievedPassages": [],
+                "timings": {"total": time.perf_counter() - startTime},
+                "error": str(e)}
@@ -0,0 +1,260 @@
+import openai
+import time
+import asyncio
+import random
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from ContextPacker import countTokens
+from Tracing import tracer
+
+
+''' Default per-model rate limits (requests per minute, tokens per minute). Set them to your organization's limits with OpenAIClient(rateLimits=...). '''
+modelRateLimits = {"gpt-3.5-turbo": {"requestsPerMinute": 3500, "tokensPerMinute": 90000},
+                   "gpt-4-0314": {"requestsPerMinute": 200, "tokensPerMinute": 40000}}
+
+# OpenAI errors that are worth retrying
+retryableErrors = (openai.error.RateLimitError,
+                   openai.error.APIError,
+                   openai.error.Timeout,
+                   openai.error.APIConnectionError,
+                   openai.error.ServiceUnavailableError,
+                   openai.error.TryAgain)
+
+
+class TokenBucket:
+    ''' A thread-safe token bucket refilled continuously at ratePerMinute, holding at most one minute's worth of tokens '''
+    def __init__(self, ratePerMinute: float):
+        self.capacity = float(ratePerMinute)
+        self.ratePerSecond = ratePerMinute / 60.0
+        self.available = self.capacity
+        self.updatedAt = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        self.available = min(self.capacity, self.available + (now - self.updatedAt) * self.ratePerSecond)
+        self.updatedAt = now
+
+    ''' Block until the given amount can be taken (amounts above the capacity wait for a full bucket) '''
+    def acquire(self, amount: float = 1.0):
+        amount = min(amount, self.capacity)
+        while True:
+            with self.lock:
+                self.refill()
+                if self.available >= amount:
+                    self.available -= amount
+                    return
+                wait = (amount - self.available) / self.ratePerSecond
+            time.sleep(wait)
+
+    ''' Correct an earlier estimate once the real amount is known (the bucket may go negative, delaying later requests) '''
+    def adjust(self, amount: float):
+        with self.lock:
+            self.refill()
+            self.available = min(self.capacity, self.available - amount)
+
+
+class OpenAIClient:
+    ''' The layer under gptResponse that talks to OpenAI. Requests are limited per model by a requests-per-minute and a tokens-per-minute token bucket,
+        failed requests are retried with exponential backoff and full jitter (honouring retry-after hints), and connections are kept alive in a
+        pool shared by every client of the process. apiBase points the client at another endpoint, such as a local stub server. '''
+    def __init__(self, rateLimits: dict = None, maxRetries: int = 6, baseDelay: float = 1.0, maxDelay: float = 60.0, apiBase: str = None, poolSize: int = 32, requestTimeout: float = 600, expectedCompletionTokens: int = 256):
+        # model -> {"requestsPerMinute": ..., "tokensPerMinute": ...}; models without an entry are not rate limited
+        self.rateLimits = rateLimits if rateLimits is not None else modelRateLimits
+        self.maxRetries = maxRetries
+        self.baseDelay = baseDelay
+        self.maxDelay = maxDelay
+        self.apiBase = apiBase
+        self.requestTimeout = requestTimeout
+
+        # Completion tokens assumed for a request before its real usage is known
+        self.expectedCompletionTokens = expectedCompletionTokens
+
+        self.buckets = dict()
+        self.bucketsLock = threading.Lock()
+
+        self.retries = 0
+
+        # One keep-alive session shared by every thread. openai keeps the session of a thread from its first request on, so a per-client session
+        # would not hold: the first client installs its session for the whole process, and later clients (whose poolSize is then ignored) share it.
+        # Their apiBase, rate limits and retries still apply per request.
+        if isinstance(openai.requestssession, requests.Session):
+            self.session = openai.requestssession
+        else:
+            self.session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=poolSize, pool_maxsize=poolSize)
+            self.session.mount("https://", adapter)
+            self.session.mount("http://", adapter)
+            openai.requestssession = self.session
+
+
+    ''' The (request bucket, token bucket) pair of a model, or None if it is not rate limited '''
+    def bucketsFor(self, model: str):
+        if model not in self.rateLimits:
+            return None
+
+        with self.bucketsLock:
+            if model not in self.buckets:
+                limits = self.rateLimits[model]
+                self.buckets[model] = (TokenBucket(limits["requestsPerMinute"]), TokenBucket(limits["tokensPerMinute"]))
+            return self.buckets[model]
+
+
+    ''' Send a chat completion request. Extra keyword arguments (e.g. stream=True) are passed on to openai.ChatCompletion.create. '''
+    def create(self, model: str, messages, **kwargs):
+        buckets = self.bucketsFor(model)
+
+        promptTokens = sum(countTokens(message["content"], model) + 4 for message in messages)
+        estimatedTokens = promptTokens + self.expectedCompletionTokens
+
+        with tracer.span("openai.chat", model=model, stream=bool(kwargs.get("stream"))) as span:
+            if buckets is not None:
+                buckets[0].acquire(1)
+                buckets[1].acquire(estimatedTokens)
+
+            if self.apiBase is not None:
+                kwargs["api_base"] = self.apiBase
+
+            for attempt in range(self.maxRetries + 1):
+                try:
+                    response = openai.ChatCompletion.create(model=model, messages=messages, request_timeout=self.requestTimeout, **kwargs)
+                    break
+                except retryableErrors as e:
+                    if attempt == self.maxRetries:
+                        raise
+
+                    self.retries += 1
+                    span.set(retries=attempt + 1)
+                    time.sleep(self.backoffDelay(attempt, e))
+
+            # Replace the estimate by the real usage, when it is reported (streamed replies only have the prompt estimate)
+            if not kwargs.get("stream") and "usage" in response:
+                span.set(promptTokens=response["usage"]["prompt_tokens"], completionTokens=response["usage"]["completion_tokens"])
+                if buckets is not None:
+                    buckets[1].adjust(response["usage"]["total_tokens"] - estimatedTokens)
+            else:
+                span.set(promptTokens=promptTokens)
+
+        return response
+
+
+    ''' Exponential backoff with full jitter, but never shorter than the server's retry-after hint '''
+    def backoffDelay(self, attempt: int, error):
+        delay = random.uniform(0, min(self.maxDelay, self.baseDelay * (2 ** attempt)))
+
+        headers = getattr(error, "headers", None) or dict()
+        retryAfter = headers.get("retry-after") or headers.get("Retry-After")
+        if retryAfter is not None:
+            try:
+                delay = max(delay, float(retryAfter))
+            except ValueError:
+                pass
+
+        return delay
+
+
+# Used when no client is given
+defaultClient = None
+defaultClientLock = threading.Lock()
+
+
+def getDefaultClient():
+    global defaultClient
+    with defaultClientLock:
+        if defaultClient is None:
+            defaultClient = OpenAIClient()
+        return defaultClient
+
+
+''' Send a conversation to the OpenAI chat completion API and return the raw content of the reply. If a ResponseCache is given, identical requests
+    are answered from it (unless bypassCache is True). Requests go through the given OpenAIClient, or a default one. Shared by Tutor and KnowledgeBase
+    so both go through the same cache and rate limits. '''
+def chatCompletion(model: str, messages, responseCache=None, bypassCache: bool = False, client: OpenAIClient = None):
+    useCache = responseCache is not None and not bypassCache
+
+    content = responseCache.get(model, messages) if useCache else None
+    if content is None:
+        completedConversation = (client or getDefaultClient()).create(model, messages)
+        content = completedConversation['choices'][0]['message']['content']
+
+        if useCache:
+            responseCache.put(model, messages, content)
+
+    return content
+
+
+class StreamedCompletion:
+    ''' A streamed chat completion. Iterating over it (or using "async for") yields the reply's tokens as they arrive. Once exhausted, text holds the
+        whole reply, and timeToFirstToken and totalTime hold the latencies in seconds. A cached reply is yielded as a single token. '''
+    def __init__(self, model: str, messages, responseCache=None, bypassCache: bool = False, flattenNewlines: bool = False, onComplete=None, client: OpenAIClient = None):
+        self.model = model
+        self.client = client
+        self.messages = messages
+        self.responseCache = responseCache
+        self.bypassCache = bypassCache
+
+        # If True, newlines are replaced by spaces, as gptResponse does for complete replies
+        self.flattenNewlines = flattenNewlines
+
+        # Called with this object once the reply is complete
+        self.onComplete = onComplete
+
+        self.text = None
+        self.timeToFirstToken = None
+        self.totalTime = None
+        self.fromCache = False
+
+        self.tokens = self.generate()
+
+    def __iter__(self):
+        return self.tokens
+
+    def __next__(self):
+        return next(self.tokens)
+
+    def __aiter__(self):
+        return self
+
+    ''' Fetch the next token on the default executor so the event loop is not blocked '''
+    async def __anext__(self):
+        token = await asyncio.get_running_loop().run_in_executor(None, next, self.tokens, None)
+        if token is None:
+            raise StopAsyncIteration
+        return token
+
+    def generate(self):
+        startTime = time.perf_counter()
+        useCache = self.responseCache is not None and not self.bypassCache
+
+        content = self.responseCache.get(self.model, self.messages) if useCache else None
+        if content is not None:
+            self.fromCache = True
+            self.timeToFirstToken = time.perf_counter() - startTime
+            yield self.flatten(content)
+        else:
+            pieces = []
+            for chunk in (self.client or getDefaultClient()).create(self.model, self.messages, stream=True):
+                token = chunk['choices'][0]['delta'].get('content')
+                if not token:
+                    continue
+
+                if self.timeToFirstToken is None:
+                    self.timeToFirstToken = time.perf_counter() - startTime
+                pieces.append(token)
+                yield self.flatten(token)
+
+            content = "".join(pieces)
+            if useCache:
+                self.responseCache.put(self.model, self.messages, content)
+
+        self.text = self.flatten(content)
+        self.totalTime = time.perf_counter() - startTime
+
+        if self.onComplete is not None:
+            self.onComplete(self)
+
+    def flatten(self, text: str):
+        return text.replace("\n", " ") if self.flattenNewlines else text
@@ -0,0 +1,113 @@
+from InMemoryBM25 import tokenize, sentencePattern
+
+# tiktoken gives exact token counts; without it a characters/4 estimate is used
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+
+''' Default number of tokens of lecture material added to a GPT request, per model '''
+modelContextBudgets = {"gpt-3.5-turbo": 1500,
+                       "gpt-4-0314": 3000}
+
+''' The system message every piece of lecture material is wrapped in '''
+lectureMaterialTemplate = 'Please note the following lecture material that may be related to this topic: "{}".'
+
+# Tokens the chat format adds to every message on top of its content
+messageOverheadTokens = 4
+
+encodings = dict()
+
+
+''' Count the tokens of a text for the given model '''
+def countTokens(text: str, model: str):
+    if tiktoken is None:
+        return max(1, (len(text) + 3) // 4)
+
+    if model not in encodings:
+        try:
+            encodings[model] = tiktoken.encoding_for_model(model)
+        except KeyError:
+            encodings[model] = tiktoken.get_encoding("cl100k_base")
+
+    return len(encodings[model].encode(text))
+
+
+class ContextPacker:
+    ''' Chooses which retrieved lecture material goes into a GPT request. Candidates are ranked by retriever score and keyword hits, sentences that
+        were already included are dropped, and passages that do not fit are trimmed to their most relevant sentences so the whole context stays
+        within a token budget. '''
+    def __init__(self, model: str, tokenBudget: int = None, keywordWeight: float = 0.5):
+        self.model = model
+        self.tokenBudget = tokenBudget if tokenBudget is not None else modelContextBudgets.get(model, 1500)
+
+        # Weight of the (normalized) keyword hits relative to the (normalized) retriever score when ranking candidates
+        self.keywordWeight = keywordWeight
+
+
+    ''' Pack the candidates for this question and answer. Each candidate is a dict with "lineNumber", "text", "retrievalScore" and "keywordHits".
+        Returns the chosen passages (in line order) and the number of tokens they use once wrapped in their system messages. '''
+    def pack(self, candidates, question: str, answer: str):
+        queryTerms = set(tokenize(question + " " + answer))
+
+        maxScore = max([candidate["retrievalScore"] or 0.0 for candidate in candidates] + [0.0])
+        maxHits = max([candidate["keywordHits"] for candidate in candidates] + [0])
+
+        def rankScore(candidate):
+            score = (candidate["retrievalScore"] or 0.0) / maxScore if maxScore > 0 else 0.0
+            hits = candidate["keywordHits"] / maxHits if maxHits > 0 else 0.0
+            return score + self.keywordWeight * hits
+
+        ranked = sorted(candidates, key=lambda candidate: (rankScore(candidate), -candidate["lineNumber"]), reverse=True)
+
+        wrapperTokens = countTokens(lectureMaterialTemplate.format(""), self.model) + messageOverheadTokens
+        seenSentences = set()
+        chosen = dict()     # line number -> passage
+        usedTokens = 0
+        trimmed = 0
+
+        for candidate in ranked:
+            remaining = self.tokenBudget - usedTokens - wrapperTokens
+            if remaining <= 0:
+                break
+
+            # Drop sentences that an earlier (better ranked) passage already contains
+            sentences = []
+            for sentence in sentencePattern.split(candidate["text"].strip()):
+                key = " ".join(tokenize(sentence))
+                if key == "" or key in seenSentences:
+                    continue
+                sentences.append((sentence, key, countTokens(sentence, self.model)))
+
+            if len(sentences) == 0:
+                continue
+
+            if sum(tokens for _, _, tokens in sentences) + len(sentences) - 1 > remaining:
+                # Keep the sentences that overlap the question/answer the most, as long as they fit, in their original order
+                order = sorted(range(len(sentences)), key=lambda i: (len(queryTerms & set(sentences[i][1].split())), -i), reverse=True)
+                keep = set()
+                keptTokens = 0
+                for i in order:
+                    if len(queryTerms & set(sentences[i][1].split())) == 0:
+                        break
+                    if keptTokens + sentences[i][2] + 1 <= remaining:
+                        keep.add(i)
+                        keptTokens += sentences[i][2] + 1
+
+                sentences = [sentences[i] for i in sorted(keep)]
+                trimmed += 1
+                if len(sentences) == 0:
+                    continue
+
+            passage = " ".join(sentence for sentence, _, _ in sentences)
+            chosen[candidate["lineNumber"]] = passage
+            usedTokens += countTokens(lectureMaterialTemplate.format(passage), self.model) + messageOverheadTokens
+            seenSentences.update(key for _, key, _ in sentences)
+
+        return {"passages": [chosen[lineNumber] for lineNumber in sorted(chosen)],
+                "lineNumbers": sorted(chosen),
+                "tokens": usedTokens,
+                "budget": self.tokenBudget,
+                "candidates": len(candidates),
+                "trimmed": trimmed}
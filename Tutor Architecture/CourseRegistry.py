@@ -0,0 +1,193 @@
+import hashlib
+import json
+import os
+import re
+import sys
+import threading
+from collections import OrderedDict
+
+from KnowledgeBase import KnowledgeBase
+from Tutor import Tutor
+
+
+# Knowledge base attributes that are shared with other courses or not course data, and are left out of its memory estimate. The FARMReader is
+# loaded once per process (see KnowledgeBase.sharedReader), so evicting a course does not free it.
+sharedAttributes = {"reader", "retriever", "responseCache", "openAIClient", "retrievalLock"}
+
+
+''' Approximate number of bytes used by a knowledge base's course data (supervisor files, keywords, processed lines, keyword matcher, BM25 index...) '''
+def estimateKnowledgeBaseBytes(knowledgeBase: KnowledgeBase):
+    seen = set()
+    total = 0
+    pending = [value for name, value in vars(knowledgeBase).items() if name not in sharedAttributes]
+
+    while pending:
+        obj = pending.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+
+        if isinstance(obj, dict):
+            pending.extend(obj.keys())
+            pending.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            pending.extend(obj)
+        elif hasattr(obj, "__dict__") and not isinstance(obj, type):
+            pending.extend(vars(obj).values())
+
+    return total
+
+
+class CourseRegistry:
+    ''' The knowledge bases of many courses, for one long-lived process serving all of them. Every course has its own directory (holding its
+        SupervisorFiles, HaystackSearch and HaystackIndex directories) and its own Elasticsearch index, so courses never overwrite each other's
+        artifacts. A course's knowledge base is built on first use and kept in memory until the estimated memory of all loaded courses exceeds
+        memoryLimitBytes, at which point the least recently used courses are evicted (and rebuilt from their persisted artifacts when used again). '''
+    def __init__(self, rootDirectory: str = "./Courses", memoryLimitBytes: int = 1024 * 1024 * 1024, **knowledgeBaseSettings):
+        # Courses are discovered in the subdirectories of rootDirectory that contain a course.json file ({"lessonSubject": ...})
+        self.rootDirectory = rootDirectory
+        self.memoryLimitBytes = memoryLimitBytes
+
+        # Keyword arguments passed to every KnowledgeBase (API_KEY, model, retrievalBackend, responseCache, openAIClient...)
+        self.knowledgeBaseSettings = knowledgeBaseSettings
+
+        self.courses = dict()           # course ID -> {"lessonSubject", "directory", "settings"}
+        self.loaded = OrderedDict()     # course ID -> (knowledge base, estimated bytes), least recently used first
+        self.lock = threading.Lock()
+        self.courseLocks = dict()       # course ID -> lock held while the course loads, so it is only built once
+
+        # Called with the ID of every evicted course, so that holders of its knowledge base (e.g. cached tutors) can let go of it
+        self.evictionListeners = []
+
+        self.loads = 0
+        self.evictions = 0
+
+        if rootDirectory is not None and os.path.isdir(rootDirectory):
+            self.discover()
+
+
+    ''' Register every course directory under rootDirectory that has a course.json file '''
+    def discover(self):
+        for courseId in sorted(os.listdir(self.rootDirectory)):
+            configPath = os.path.join(self.rootDirectory, courseId, "course.json")
+            if os.path.isfile(configPath) and courseId not in self.courses:
+                with open(configPath) as fh:
+                    config = json.load(fh)
+                self.register(courseId, **config)
+
+        return list(self.courses)
+
+
+    ''' Register a course. Its directory defaults to rootDirectory/courseId; extra keyword arguments override the registry's knowledge base settings for this course. '''
+    def register(self, courseId: str, lessonSubject: str = None, directory: str = None, **settings):
+        if lessonSubject is None:
+            raise Exception('No lesson subject is present for course "' + courseId + '"')
+
+        if directory is None:
+            directory = os.path.join(self.rootDirectory, courseId)
+
+        if not os.path.isdir(os.path.join(directory, "SupervisorFiles")):
+            raise Exception('Course "' + courseId + '" has no SupervisorFiles directory in ' + directory)
+
+        with self.lock:
+            self.courses[courseId] = {"lessonSubject": lessonSubject, "directory": directory, "settings": settings}
+            self.courseLocks.setdefault(courseId, threading.Lock())
+
+
+    ''' The Elasticsearch index of a course: its ID made safe for index names, plus a short hash so that distinct IDs never share an index '''
+    @staticmethod
+    def indexName(courseId: str):
+        slug = re.sub(r"[^a-z0-9_]+", "_", courseId.lower()).strip("_")
+        return "course_" + slug + "_" + hashlib.sha256(courseId.encode("utf-8")).hexdigest()[:8]
+
+
+    ''' The knowledge base of a course, building it on first use '''
+    def get(self, courseId: str):
+        with self.lock:
+            if courseId not in self.courses:
+                raise Exception('Unknown course "' + courseId + '"')
+
+            if courseId in self.loaded:
+                self.loaded.move_to_end(courseId)
+                return self.loaded[courseId][0]
+
+            courseLock = self.courseLocks[courseId]
+
+        # Build outside the registry lock so other courses stay available; concurrent first uses of this course wait for one build
+        with courseLock:
+            with self.lock:
+                if courseId in self.loaded:
+                    self.loaded.move_to_end(courseId)
+                    return self.loaded[courseId][0]
+                course = self.courses[courseId]
+
+            knowledgeBase = KnowledgeBase(lessonSubject=course["lessonSubject"], courseDirectory=course["directory"], indexName=self.indexName(courseId),
+                                          **dict(self.knowledgeBaseSettings, **course["settings"]))
+            estimatedBytes = estimateKnowledgeBaseBytes(knowledgeBase)
+
+            with self.lock:
+                self.loaded[courseId] = (knowledgeBase, estimatedBytes)
+                self.loads += 1
+                evicted = self.evictLeastRecentlyUsed(keep=courseId)
+            self.notifyEvicted(evicted)
+
+        return knowledgeBase
+
+
+    ''' A tutor for a student of a course, sharing the course's knowledge base. Keyword arguments are passed to the Tutor constructor. '''
+    def tutor(self, courseId: str, studentName: str, **tutorSettings):
+        knowledgeBase = self.get(courseId)
+        for name in ["API_KEY", "model", "responseCache", "openAIClient"]:
+            if name in self.knowledgeBaseSettings:
+                tutorSettings.setdefault(name, self.knowledgeBaseSettings[name])
+
+        return Tutor(studentName=studentName, knowledgeBase=knowledgeBase, **tutorSettings)
+
+
+    ''' Drop a course's knowledge base from memory (tutors that still hold it keep it alive until they are gone) '''
+    def evict(self, courseId: str):
+        with self.lock:
+            if self.loaded.pop(courseId, None) is None:
+                return
+            self.evictions += 1
+        self.notifyEvicted([courseId])
+
+
+    ''' Evict the least recently used courses until the loaded ones fit in memoryLimitBytes, never evicting the course being loaded (caller holds the lock
+        and notifies the listeners of the returned course IDs once it has released it) '''
+    def evictLeastRecentlyUsed(self, keep: str = None):
+        evicted = []
+        while self.loadedBytes() > self.memoryLimitBytes:
+            victim = next((courseId for courseId in self.loaded if courseId != keep), None)
+            if victim is None:
+                break
+            del self.loaded[victim]
+            self.evictions += 1
+            evicted.append(victim)
+
+        return evicted
+
+
+    ''' Call listener(courseId) whenever a course is evicted '''
+    def addEvictionListener(self, listener):
+        self.evictionListeners.append(listener)
+
+    def notifyEvicted(self, courseIds):
+        for courseId in courseIds:
+            for listener in self.evictionListeners:
+                listener(courseId)
+
+
+    def loadedBytes(self):
+        return sum(estimatedBytes for _, estimatedBytes in self.loaded.values())
+
+
+    def stats(self):
+        with self.lock:
+            return {"courses": len(self.courses),
+                    "loaded": list(self.loaded),
+                    "loadedBytes": self.loadedBytes(),
+                    "memoryLimitBytes": self.memoryLimitBytes,
+                    "loads": self.loads,
+                    "evictions": self.evictions}
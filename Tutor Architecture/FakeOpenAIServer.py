@@ -0,0 +1,171 @@
+import json
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+wordPattern = re.compile(r"[a-z][a-z\-]{3,}")
+
+# Common words left out of the generated keyword lists
+stopWords = {"that", "this", "with", "from", "they", "their", "there", "which", "were", "have", "been", "into", "about", "would", "could",
+             "these", "those", "than", "then", "when", "what", "where", "while", "also", "such", "some", "more", "most", "other", "each"}
+
+
+class FakeOpenAIServer:
+    ''' A local stand-in for the OpenAI chat completion endpoint, used to run the tutors offline (see benchmarkPipeline.py). It answers keyword
+        generation, rating, combined rating and feedback prompts with plausible, deterministic replies after a configurable latency, streams replies
+        when asked to, and counts the requests and tokens it served. Point an OpenAIClient at it with apiBase=server.apiBase. To exercise retries,
+        the first failures requests can be answered with an error status (429 by default) and a Retry-After header (see checkRetries.py). '''
+    def __init__(self, latency: float = 0.0, tokenLatency: float = 0.0, host: str = "127.0.0.1", port: int = 0, failures: int = 0, failureStatus: int = 429, retryAfter: float = None):
+        # Seconds before every reply, and between the chunks of a streamed reply
+        self.latency = latency
+        self.tokenLatency = tokenLatency
+
+        # Fault injection: the first failures requests get failureStatus, with a Retry-After header of retryAfter seconds unless it is None
+        self.failures = failures
+        self.failureStatus = failureStatus
+        self.retryAfter = retryAfter
+
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.failed = 0
+        self.promptTokens = 0
+        self.completionTokens = 0
+
+        self.server = ThreadingHTTPServer((host, port), self.handlerClass())
+        self.server.daemon_threads = True
+        self.thread = None
+
+
+    @property
+    def apiBase(self):
+        host, port = self.server.server_address[:2]
+        return "http://" + host + ":" + str(port) + "/v1"
+
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+    ''' Requests and tokens served so far '''
+    def stats(self):
+        with self.lock:
+            return {"requests": self.requests, "failed": self.failed, "promptTokens": self.promptTokens, "completionTokens": self.completionTokens}
+
+
+    ''' The reply to a conversation, chosen from the kind of prompt it contains '''
+    def reply(self, messages):
+        system = " ".join(message["content"] for message in messages if message["role"] == "system")
+        lastMessage = messages[-1]["content"] if messages else ""
+
+        if "keyword generator" in system:
+            information = lastMessage.split("\n\n", 1)[-1]
+            counts = Counter(word for word in wordPattern.findall(information.lower()) if word not in stopWords)
+            return "[" + ", ".join(word for word, _ in counts.most_common(12)) + "]"
+
+        if "ranking system" in system:
+            return "4"
+
+        if "JSON array" in lastMessage:
+            match = re.search(r"create (\d+)", lastMessage)
+            count = int(match.group(1)) if match else 3
+            return json.dumps([{"question": "Which of the following statements about this subtopic are true? (" + str(i + 1) + ")",
+                                "options": {"a": "The first statement", "b": "The second statement", "c": "The third statement", "d": "The fourth statement"},
+                                "answer": ["a", "c"]} for i in range(count)])
+
+        if "JSON object" in lastMessage:
+            return json.dumps({"rating": 4, "feedback": "Mostly correct. Review the lecture material on this subtopic to complete your answer."})
+
+        return "Good effort! Your answer is mostly accurate. Look again at the lecture material to see which options you missed and why."
+
+
+    def handlerClass(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            # Headers and body are written separately; without this, delayed ACKs add ~40 ms to every reply
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                messages = request.get("messages", [])
+
+                with fake.lock:
+                    fail = fake.failed < fake.failures
+                    if fail:
+                        fake.failed += 1
+                if fail:
+                    headers = {"Retry-After": str(fake.retryAfter)} if fake.retryAfter is not None else dict()
+                    self.send(fake.failureStatus, {"error": {"message": "Injected failure", "type": "requests" if fake.failureStatus == 429 else "server_error", "param": None, "code": None}}, headers)
+                    return
+                content = fake.reply(messages)
+
+                # Rough token counts (about four characters per token)
+                promptTokens = sum(len(message["content"]) for message in messages) // 4
+                completionTokens = max(1, len(content) // 4)
+                with fake.lock:
+                    fake.requests += 1
+                    fake.promptTokens += promptTokens
+                    fake.completionTokens += completionTokens
+
+                if fake.latency > 0:
+                    time.sleep(fake.latency)
+
+                if request.get("stream"):
+                    self.stream(request.get("model"), content)
+                else:
+                    self.send(200, {"id": "chatcmpl-fake", "object": "chat.completion", "created": int(time.time()), "model": request.get("model"),
+                                    "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                                    "usage": {"prompt_tokens": promptTokens, "completion_tokens": completionTokens, "total_tokens": promptTokens + completionTokens}})
+
+            def send(self, status: int, body: dict, headers: dict = None):
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for name, value in (headers or dict()).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            ''' Send the reply word by word as server-sent events, like the streaming API '''
+            def stream(self, model: str, content: str):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Connection", "close")
+                self.end_headers()
+
+                pieces = re.findall(r"\S+\s*", content)
+                for piece in [None] + pieces:
+                    delta = {"role": "assistant"} if piece is None else {"content": piece}
+                    chunk = {"id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+                             "choices": [{"index": 0, "delta": delta, "finish_reason": None}]}
+                    self.wfile.write(b"data: " + json.dumps(chunk).encode("utf-8") + b"\n\n")
+                    self.wfile.flush()
+                    if piece is not None and fake.tokenLatency > 0:
+                        time.sleep(fake.tokenLatency)
+
+                self.wfile.write(b"data: [DONE]\n\n")
+                self.wfile.flush()
+                self.close_connection = True
+
+        return Handler
@@ -0,0 +1,235 @@
+import json
+import math
+import os
+import re
+import heapq
+from array import array
+from collections.abc import Sequence
+
+
+''' Tokenization used for both indexing and querying (lowercased word characters, similar to the Elasticsearch standard analyzer) '''
+tokenPattern = re.compile(r"\w+")
+sentencePattern = re.compile(r"(?<=[.!?])\s+")
+
+
+def tokenize(text: str):
+    return tokenPattern.findall(text.lower())
+
+
+''' Split a piece of text into overlapping word windows that respect sentence boundaries. This mirrors the PreProcessor settings used by the Elasticsearch pipeline. Passages are exact substrings of the text, so they can still be located in the file they came from. '''
+def splitPassages(text: str, splitLength: int = 100, splitOverlap: int = 50):
+    return [text[start:end] for start, end in passageSpans(text, splitLength, splitOverlap)]
+
+
+''' The (start, end) offsets in text of the passages splitPassages returns, so that a passage can be stored as a reference to the text it came from '''
+def passageSpans(text: str, splitLength: int = 100, splitOverlap: int = 50):
+    # Surrounding whitespace is left out of every passage
+    textStart = len(text) - len(text.lstrip())
+    textEnd = len(text.rstrip())
+
+    # (start, end, word count) for every sentence in the text
+    sentences = []
+    start = textStart
+    for match in sentencePattern.finditer(text, textStart, textEnd):
+        sentences.append((start, match.start(), len(text[start:match.start()].split())))
+        start = match.end()
+    if start < textEnd:
+        sentences.append((start, textEnd, len(text[start:textEnd].split())))
+
+    passages = []
+    current = []
+    currentLength = 0
+    for sentence in sentences:
+        if current and currentLength + sentence[2] > splitLength:
+            passages.append((current[0][0], current[-1][1]))
+
+            # Carry over the trailing sentences that fit inside the overlap window
+            overlap = []
+            overlapLength = 0
+            for previous in reversed(current):
+                if overlapLength + previous[2] > splitOverlap:
+                    break
+                overlap.insert(0, previous)
+                overlapLength += previous[2]
+            current = overlap
+            currentLength = overlapLength
+
+        current.append(sentence)
+        currentLength += sentence[2]
+
+    if current:
+        passages.append((current[0][0], current[-1][1]))
+
+    return passages
+
+
+class PassageReferences(Sequence):
+    ''' The documents of an index whose lines are stored elsewhere (e.g. in a knowledge pack): every passage is kept as the line number and the
+        (start, end) offsets of its span in that line, and its content and metadata are read from the lines when the document is accessed. Only the
+        offsets are held in memory and persisted with the index. '''
+    def __init__(self, readLine, readMeta, lineNumbers=(), starts=(), ends=()):
+        self.readLine = readLine
+        self.readMeta = readMeta
+        self.lineNumbers = array('i', lineNumbers)
+        self.starts = array('i', starts)
+        self.ends = array('i', ends)
+
+    def append(self, lineNumber: int, start: int, end: int):
+        self.lineNumbers.append(lineNumber)
+        self.starts.append(start)
+        self.ends.append(end)
+
+    def __len__(self):
+        return len(self.lineNumbers)
+
+    def __getitem__(self, docId):
+        if docId < 0 or docId >= len(self.lineNumbers):
+            raise IndexError(docId)
+        lineNumber = self.lineNumbers[docId]
+        return {"content": self.readLine(lineNumber)[self.starts[docId]:self.ends[docId]], "meta": self.readMeta(lineNumber)}
+
+    def serialize(self):
+        return {"lineNumbers": list(self.lineNumbers), "starts": list(self.starts), "ends": list(self.ends)}
+
+
+class RetrievedDocument:
+    ''' A retrieved passage with the attributes of a Haystack Document that retrieval uses (content, meta, score), so that "retriever" mode does not need Haystack '''
+    def __init__(self, content: str, meta: dict = None, score: float = None):
+        self.content = content
+        self.meta = meta if meta is not None else dict()
+        self.score = score
+
+
+class InMemoryBM25Index:
+    ''' A pure-Python BM25 inverted index used in place of Elasticsearch '''
+    def __init__(self, k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+
+        self.documents = []        # list of {"content": str, "meta": dict}, or PassageReferences
+        self.documentLengths = array('i')
+        self.averageLength = 0.0
+        self.idf = dict()          # term -> inverse document frequency
+        self.postings = dict()     # term -> (array of document ids, array of term frequencies)
+        self.fingerprint = None
+
+
+    ''' Build the term statistics and postings arrays for the given documents '''
+    def build(self, documents):
+        self.documents = documents if isinstance(documents, PassageReferences) else list(documents)
+        self.documentLengths = array('i')
+        termFrequencies = dict()
+
+        for docId, document in enumerate(self.documents):
+            tokens = tokenize(document["content"])
+            self.documentLengths.append(len(tokens))
+
+            counts = dict()
+            for token in tokens:
+                counts[token] = counts.get(token, 0) + 1
+            for term, count in counts.items():
+                termFrequencies.setdefault(term, []).append((docId, count))
+
+        documentCount = len(self.documents)
+        self.averageLength = (sum(self.documentLengths) / documentCount) if documentCount else 0.0
+
+        self.postings = dict()
+        self.idf = dict()
+        for term, entries in termFrequencies.items():
+            self.postings[term] = (array('i', [docId for docId, _ in entries]), array('i', [count for _, count in entries]))
+            self.idf[term] = math.log(1 + (documentCount - len(entries) + 0.5) / (len(entries) + 0.5))
+
+        return self
+
+
+    ''' Score every document containing a query term and return the top-k documents with their scores. Like Haystack's BM25Retriever, scores are scaled to 0-1 unless scaleScore is False. '''
+    def retrieve(self, query: str, topK: int = 3, scaleScore: bool = True):
+        return self.retrieveBatch([query], topK, scaleScore)[0]
+
+
+    ''' Retrieve the top-k documents of several queries in one pass. The postings of a term are scored once and shared by every query containing it (the question and answer of a graded answer share many terms). '''
+    def retrieveBatch(self, queries, topK: int = 3, scaleScore: bool = True):
+        termScores = dict()     # term -> {document id: BM25 score of the term}
+        results = []
+
+        for query in queries:
+            scores = dict()
+            for term in set(tokenize(query)):
+                if term not in self.postings:
+                    continue
+
+                if term not in termScores:
+                    termScores[term] = self.scoreTerm(term)
+                for docId, score in termScores[term].items():
+                    scores[docId] = scores.get(docId, 0.0) + score
+
+            best = heapq.nlargest(topK, scores.items(), key=lambda item: (item[1], -item[0]))
+
+            if scaleScore:
+                best = [(docId, 1 / (1 + math.exp(-score / 8))) for docId, score in best]
+
+            results.append([{"content": self.documents[docId]["content"], "meta": dict(self.documents[docId]["meta"]), "score": score} for docId, score in best])
+
+        return results
+
+
+    ''' The BM25 score of a term in every document containing it '''
+    def scoreTerm(self, term: str):
+        docIds, frequencies = self.postings[term]
+        idf = self.idf[term]
+
+        scores = dict()
+        for docId, frequency in zip(docIds, frequencies):
+            norm = self.k1 * (1 - self.b + self.b * self.documentLengths[docId] / self.averageLength)
+            scores[docId] = idf * frequency * (self.k1 + 1) / (frequency + norm)
+
+        return scores
+
+
+    ''' Persist the index to disk as JSON '''
+    def save(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+        serialized = {"fingerprint": self.fingerprint,
+                      "k1": self.k1,
+                      "b": self.b,
+                      "documentLengths": list(self.documentLengths),
+                      "averageLength": self.averageLength,
+                      "idf": self.idf,
+                      "postings": {term: [list(docIds), list(frequencies)] for term, (docIds, frequencies) in self.postings.items()}}
+
+        # Passage references are saved as their offsets; the passages themselves stay in the lines they point to
+        if isinstance(self.documents, PassageReferences):
+            serialized["passages"] = self.documents.serialize()
+        else:
+            serialized["documents"] = self.documents
+
+        temporaryPath = path + ".tmp"
+        with open(temporaryPath, "w") as outfile:
+            json.dump(serialized, outfile)
+        os.replace(temporaryPath, path)
+
+
+    ''' Load a previously persisted index. Returns None if it does not exist, or if it stores passage references and readLine and readMeta (which
+        resolve them, see PassageReferences) are not given. '''
+    @classmethod
+    def load(cls, path: str, readLine=None, readMeta=None):
+        if not os.path.exists(path):
+            return None
+
+        with open(path) as fh:
+            serialized = json.load(fh)
+
+        passages = serialized.get("passages")
+        if passages is not None and (readLine is None or readMeta is None):
+            return None
+
+        index = cls(k1=serialized["k1"], b=serialized["b"])
+        index.fingerprint = serialized["fingerprint"]
+        index.documents = serialized["documents"] if passages is None else PassageReferences(readLine, readMeta, **passages)
+        index.documentLengths = array('i', serialized["documentLengths"])
+        index.averageLength = serialized["averageLength"]
+        index.idf = serialized["idf"]
+        index.postings = {term: (array('i', docIds), array('i', frequencies)) for term, (docIds, frequencies) in serialized["postings"].items()}
+
+        return index
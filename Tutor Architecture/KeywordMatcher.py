@@ -0,0 +1,82 @@
+from collections import deque
+
+
+class KeywordMatcher:
+    ''' An Aho-Corasick automaton compiled once from the subtopic keywords. Scanning a text finds every keyword occurrence in a single linear pass. '''
+    def __init__(self, keywordsBySubtopic: dict = None):
+        # keywordsBySubtopic: subtopic ID -> list of keywords
+        if keywordsBySubtopic is None:
+            keywordsBySubtopic = dict()
+
+        self.transitions = [dict()]   # state -> {character: next state}
+        self.failure = [0]            # state -> failure state
+        self.outputs = [[]]           # state -> subtopic IDs of every keyword ending at this state (including via failure links)
+
+        for subtopicId, keywords in keywordsBySubtopic.items():
+            # Duplicate keywords within a subtopic should only be counted once; empty keywords would match everything
+            for keyword in {keyword.lower() for keyword in keywords if keyword}:
+                self.addKeyword(keyword, subtopicId)
+
+        self.compile()
+
+
+    ''' Build a matcher from the generated keywords dict (encoding -> subtopic name -> keywords). Subtopic IDs are the 1-based line numbers used by processedLectureMaterial.txt. '''
+    @classmethod
+    def fromGeneratedKeywords(cls, generatedKeywords: dict, topicEncodings, lectureMaterial: dict):
+        keywordsBySubtopic = dict()
+
+        subtopicId = 0
+        for encoding in topicEncodings:
+            for subtopic in lectureMaterial[encoding]:
+                subtopicId += 1
+                keywordsBySubtopic[subtopicId] = list(generatedKeywords.get(encoding, dict()).get(subtopic["name"], [])) + list(subtopic.get("keywords", []))
+
+        return cls(keywordsBySubtopic)
+
+
+    ''' Add a keyword to the trie (before compile() is called) '''
+    def addKeyword(self, keyword: str, subtopicId):
+        state = 0
+        for character in keyword:
+            nextState = self.transitions[state].get(character)
+            if nextState is None:
+                nextState = len(self.transitions)
+                self.transitions.append(dict())
+                self.failure.append(0)
+                self.outputs.append([])
+                self.transitions[state][character] = nextState
+            state = nextState
+
+        self.outputs[state].append(subtopicId)
+
+
+    ''' Compute the failure links breadth-first and merge the outputs along them '''
+    def compile(self):
+        queue = deque(self.transitions[0].values())
+        while queue:
+            state = queue.popleft()
+            for character, nextState in self.transitions[state].items():
+                queue.append(nextState)
+
+                fallback = self.failure[state]
+                while fallback and character not in self.transitions[fallback]:
+                    fallback = self.failure[fallback]
+                self.failure[nextState] = self.transitions[fallback].get(character, 0)
+                self.outputs[nextState] = self.outputs[nextState] + self.outputs[self.failure[nextState]]
+
+
+    ''' Scan each text once (case-insensitively) and return a dict of subtopic ID -> number of keyword occurrences. Texts are scanned separately, so keywords never match across two texts. '''
+    def match(self, *texts):
+        counts = dict()
+
+        for text in texts:
+            state = 0
+            for character in text.lower():
+                while state and character not in self.transitions[state]:
+                    state = self.failure[state]
+                state = self.transitions[state].get(character, 0)
+
+                for subtopicId in self.outputs[state]:
+                    counts[subtopicId] = counts.get(subtopicId, 0) + 1
+
+        return counts
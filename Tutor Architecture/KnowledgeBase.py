@@ -0,0 +1,768 @@
+import openai
+import json
+import os
+import hashlib
+import threading
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+
+
+import logging
+
+logging.basicConfig(format="%(levelname)s - %(name)s -  %(message)s", level=logging.WARNING)
+logging.getLogger("haystack").setLevel(logging.INFO)
+
+# You will need pip install 'farm-haystack[all]' to obtain Haystack dependencies; this will take a couple of minutes.
+# Haystack (and torch through it) is only imported by importHaystack() once a knowledge base with lecture material is initialized, and only the parts
+# its backend and mode use, so that tutors without lecture material or the reader start quickly.
+ElasticsearchDocumentStore = launch_es = FARMReader = BM25Retriever = PreProcessor = Pipeline = Document = None
+
+from InMemoryBM25 import InMemoryBM25Index, PassageReferences, RetrievedDocument, splitPassages, passageSpans
+from KeywordMatcher import KeywordMatcher
+from KnowledgePack import KnowledgePack, PackLectureMaterial, PackGeneratedKeywords, PackLines, PackProcessedLines, formatProcessedLine, sourceFingerprint
+from ResponseCache import ResponseCache
+from ChatClient import chatCompletion, OpenAIClient
+from Tracing import tracer
+
+
+''' Import the Haystack classes a knowledge base needs on first use: the Elasticsearch classes only for the "elasticsearch" backend and the FARMReader
+    (which brings in torch) only in "reader" mode. The in-memory backend in "retriever" mode needs no Haystack at all. '''
+def importHaystack(retrievalBackend: str, retrievalMode: str):
+    global ElasticsearchDocumentStore, launch_es, FARMReader, BM25Retriever, PreProcessor, Pipeline, Document
+    needsElasticsearch = retrievalBackend == "elasticsearch" and ElasticsearchDocumentStore is None
+    needsReader = retrievalMode == "reader" and FARMReader is None
+    if not needsElasticsearch and not needsReader:
+        return
+
+    with tracer.span("importHaystack", backend=retrievalBackend, mode=retrievalMode):
+        from haystack.schema import Document
+        if needsElasticsearch:
+            from haystack.document_stores import ElasticsearchDocumentStore
+            from haystack.utils import launch_es
+            from haystack.nodes import BM25Retriever
+            from haystack.nodes.preprocessor import PreProcessor
+            from haystack.pipelines import Pipeline
+        if needsReader:
+            from haystack.nodes import FARMReader
+
+
+''' The stable ID of a subtopic in the retrieval index: its topic encoding and name, which (unlike its line number) do not change when other subtopics are added or removed '''
+def subtopicId(encoding, name: str):
+    return str(encoding) + "/" + name
+
+
+# The FARMReader is loaded once per process and shared by every knowledge base in "reader" mode (e.g. all the courses of a CourseRegistry), together
+# with the lock that serializes its use across them
+readerModel = "deepset/roberta-base-squad2"
+sharedReaders = dict()
+sharedReadersLock = threading.Lock()
+
+
+''' The process's reader for the given model and the lock held while it predicts, loading it on first use '''
+def sharedReader(modelName: str = readerModel):
+    with sharedReadersLock:
+        if modelName not in sharedReaders:
+            with tracer.span("loadReader"):
+                sharedReaders[modelName] = (FARMReader(model_name_or_path=modelName, use_gpu=True), threading.Lock())
+        return sharedReaders[modelName]
+
+
+class KnowledgeBase:
+    ''' The knowledge base of a lesson subject: the parsed supervisor files, generated keywords, keyword matcher, retrieval index and reader.
+        It is built once and can be shared by any number of Tutor instances; retrieval is thread-safe. '''
+    def __init__(self, API_KEY: str = None, lessonSubject: str = None, model: int = None, topicsInformationIncluded: bool = False, lectureMaterialIncluded: bool = False, retrievalBackend: str = "elasticsearch", responseCache: ResponseCache = None, keywordWorkers: int = 4, retrievalMode: str = "reader", minRetrievalScore: float = None, openAIClient: OpenAIClient = None, courseDirectory: str = ".", indexName: str = "document", knowledgePack: bool = False):
+        ''' OpenAI API Key '''
+        # Saves API key, if present (needed to generate keywords)
+        if API_KEY is None:
+            raise Exception("No Open AI API key is present")
+        else:
+            openai.api_key = API_KEY
+
+        ''' Model Number (3 or 4)  '''
+        # Model used to generate keywords
+        if model not in {3,4}:
+            raise Exception("Bad model number")
+        elif model == 3:
+            self.model = "gpt-3.5-turbo"
+        elif model == 4:
+            self.model = "gpt-4-0314"
+
+        ''' GPT Response Cache '''
+        self.responseCache = responseCache
+
+        ''' OpenAI Client '''
+        self.openAIClient = openAIClient
+
+
+        ''' Knowledge Base Depth Parameters '''
+        # Saves lesson subject, if present
+        if lessonSubject is None:
+            raise Exception("No lesson subject is present")
+        else:
+            self.lessonSubject = lessonSubject
+
+
+        ''' Keyword Generation Workers '''
+        # Maximum number of concurrent GPT requests used when (re)generating subtopic keywords
+        self.keywordWorkers = keywordWorkers
+
+        # If True, allows the topicsList.json file to be read (where subtopic information should exist)
+        self.topicsListIncluded = topicsInformationIncluded
+
+        # If True, allows the topicsInformationList.json file to be read (where subtopic descriptions should exist)
+        self.topicsInformationIncluded = topicsInformationIncluded
+
+        # If True, allows the lectureMaterial.json file to be read (where lecture information is taken)
+        self.lectureMaterialIncluded = lectureMaterialIncluded
+
+        ''' Retrieval Backend ("elasticsearch" or "inmemory") '''
+        # The in-memory backend keeps a BM25 index in-process and does not require Docker or Elasticsearch
+        if retrievalBackend not in {"elasticsearch", "inmemory"}:
+            raise Exception("Bad retrieval backend")
+        else:
+            self.retrievalBackend = retrievalBackend
+
+        ''' Retrieval Mode ("reader" or "retriever") '''
+        # "reader" runs the FARMReader over the retrieved documents to pick the relevant lines. "retriever" maps the top retrieved documents straight to
+        # their lines, which avoids a RoBERTa forward pass per query and is much faster on CPU.
+        if retrievalMode not in {"reader", "retriever"}:
+            raise Exception("Bad retrieval mode")
+        else:
+            self.retrievalMode = retrievalMode
+
+        # In "retriever" mode, lines whose best document score (scaled to 0-1) is below this are dropped
+        self.minRetrievalScore = minRetrievalScore
+
+        ''' Course Directory & Index Name '''
+        # The supervisor files are read from, and the generated artifacts written to, this course's SupervisorFiles, HaystackSearch and HaystackIndex
+        # directories. Knowledge bases of different courses need different directories and Elasticsearch index names (see CourseRegistry).
+        self.courseDirectory = courseDirectory
+        self.supervisorDirectory = os.path.join(courseDirectory, "SupervisorFiles")
+        self.searchDirectory = os.path.join(courseDirectory, "HaystackSearch")
+        self.indexDirectory = os.path.join(courseDirectory, "HaystackIndex")
+        self.indexName = indexName
+
+        ''' Knowledge Pack '''
+        # If True, the supervisor files and generated keywords are compiled into HaystackIndex/knowledge.pack and the lecture material is read from
+        # it through mmap (see KnowledgePack.py). While the pack is up to date, startup skips parsing the supervisor files altogether.
+        self.useKnowledgePack = knowledgePack
+        self.knowledgePack = None
+
+
+        # Serializes access to the Haystack reader when the knowledge base is used from several threads (replaced by the shared reader's lock in "reader" mode)
+        self.retrievalLock = threading.Lock()
+
+        if not self.openKnowledgePack():
+            # Checks to ensure the subtopics list is reflected correctly in the lectureMaterial.txt file
+            self.supervisorFileReading()
+
+
+            ''' Keywords File Creation & Lecture Material Processing'''
+            self.createKeywordsFile()
+
+            ''' Knowledge Pack Compilation '''
+            if self.useKnowledgePack and self.lectureMaterialIncluded:
+                self.buildKnowledgePack()
+                self.openKnowledgePack()
+
+        ''' Keyword Matcher Compilation '''
+        self.createKeywordMatcher()
+
+        ''' Haystack Initialization '''
+        self.haystackInitialization()
+
+
+    ''' Returns a GPT generated response to the given conversation (used for keyword generation) '''
+    def gptResponse(self,concatenatedConversation = None, bypassCache: bool = False):
+        if concatenatedConversation is None:
+            return None
+
+        return chatCompletion(self.model, concatenatedConversation, self.responseCache, bypassCache, self.openAIClient).replace("\n"," ")
+
+
+    ''' Read the supervisor files given '''
+    def supervisorFileReading(self):
+        ''' Read supervisor files and extract information from them '''
+
+
+        ''' Create placeholders for potential information '''
+        self.topicEncodings = None
+        self.topicsList = None
+        self.topicsInformation = None
+        self.lectureMaterial = None
+        self.predefinedQuestions = None
+
+        ''' Extract necessary information '''
+        if self.topicsListIncluded:
+            self.topicsList = self.jsonToDict('topicsList.json')
+            self.topicEncodings = list(self.topicsList.keys())
+
+        if self.topicsInformationIncluded:
+            self.topicsInformation = self.jsonToDict('topicsInformationList.json')
+
+        if self.lectureMaterialIncluded:
+            self.lectureMaterial = self.jsonToDict('lectureMaterial.json')
+
+
+        ''' Ensure proper formatting '''
+        if self.topicsListIncluded:
+            for encoding in self.topicEncodings:
+                if self.topicsInformationIncluded and encoding not in self.topicsInformation:
+                    raise Exception('Encoding "' + encoding + '" is not present in topicsInformationList.json file.')
+
+                if self.lectureMaterialIncluded and encoding not in self.lectureMaterial:
+                    raise Exception('Encoding "' + encoding + '" is not present in lectureMaterial.json file.')
+
+
+    ''' Convert a json file from the Supervisor folder into a dict '''
+    def jsonToDict(self,fn: str = None):
+        if fn is None:
+            return None
+
+        # Convert the json file into a dictionary
+        fh = open(os.path.join(self.supervisorDirectory, fn))
+        outputDict = json.load(fh)
+        fh.close()
+
+        return outputDict
+
+
+    ''' Compile the keyword matcher used for lecture-material lookup from the generated keywords '''
+    def createKeywordMatcher(self):
+        if not self.lectureMaterialIncluded:
+            self.keywordMatcher = None
+            return
+
+        self.keywordMatcher = KeywordMatcher.fromGeneratedKeywords(self.generatedKeywords, self.topicEncodings, self.lectureMaterial)
+
+
+    ''' Create or update the file of all the generated keywords. Each subtopic's content hash is stored in generatedKeywordsHashes.json, so only new or changed subtopics are regenerated and removed subtopics are pruned. Keywords edited by hand are kept as long as their subtopic's content does not change.'''
+    def createKeywordsFile(self):
+        if not self.lectureMaterialIncluded:
+            return
+
+        outFilePath = os.path.join(self.supervisorDirectory, "generatedKeywords.json")
+        outHashPath = os.path.join(self.supervisorDirectory, "generatedKeywordsHashes.json")
+
+        oldKeywords = self.jsonToDict("generatedKeywords.json") if os.path.exists(outFilePath) else dict()
+        oldHashes = self.jsonToDict("generatedKeywordsHashes.json") if os.path.exists(outHashPath) else None
+
+        generatedKeywords = dict()
+        keywordHashes = dict()
+        toGenerate = []
+
+        for encoding in self.topicEncodings:
+            generatedKeywords[encoding] = dict()
+            keywordHashes[encoding] = dict()
+            for subtopic in self.lectureMaterial[encoding]:
+                contentHash = self.subtopicContentHash(encoding, subtopic["name"], subtopic["information"])
+                keywordHashes[encoding][subtopic["name"]] = contentHash
+
+                existingKeywords = oldKeywords.get(encoding, dict()).get(subtopic["name"])
+
+                # Keyword files made before hashes were stored are trusted as they are
+                existingHash = contentHash if oldHashes is None else oldHashes.get(encoding, dict()).get(subtopic["name"])
+
+                if existingKeywords is not None and existingHash == contentHash:
+                    generatedKeywords[encoding][subtopic["name"]] = existingKeywords
+                else:
+                    toGenerate.append((encoding, subtopic["name"], subtopic["information"]))
+
+        # Generate the missing keywords concurrently. A failed subtopic does not lose the others: they are written first, then its error is raised.
+        errors = []
+        if len(toGenerate) > 0:
+            with ThreadPoolExecutor(max_workers=self.keywordWorkers) as executor:
+                futures = [executor.submit(self.createKeywordsFromInformation, encoding, name, information) for encoding, name, information in toGenerate]
+                for (encoding, name, information), future in zip(toGenerate, futures):
+                    try:
+                        generatedKeywords[encoding][name] = future.result()
+                    except Exception as e:
+                        errors.append(e)
+
+                        # Keep its previous keywords under their previous hash (or nothing), so the next run generates it again
+                        del keywordHashes[encoding][name]
+                        oldKeywordList = oldKeywords.get(encoding, dict()).get(name)
+                        oldHash = (oldHashes or dict()).get(encoding, dict()).get(name)
+                        if oldKeywordList is not None and oldHash is not None:
+                            generatedKeywords[encoding][name] = oldKeywordList
+                            keywordHashes[encoding][name] = oldHash
+
+        # Create files (orphaned subtopics are dropped since only current subtopics are written)
+        if generatedKeywords != oldKeywords:
+            with open(outFilePath, "w") as outfile:
+                json.dump(generatedKeywords, outfile)
+
+        if keywordHashes != oldHashes:
+            with open(outHashPath, "w") as outfile:
+                json.dump(keywordHashes, outfile)
+
+        if errors:
+            raise errors[0]
+
+        self.createLectureInformationParseFile()
+
+
+    ''' Hash of everything that goes into a subtopic's keyword generation prompt '''
+    def subtopicContentHash(self,encoding,name,information):
+        content = json.dumps([self.lessonSubject, self.topicsList[encoding], name, information])
+        return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+    ''' Generate keywords for the specific subtopic given by the createKeywordsFile() method.'''
+    def createKeywordsFromInformation(self,encoding,name,information):
+            background = "You are a keyword generator. Your job is to generate keywords that students might use about certain topics when discussing them so that information can be retrieved."
+            prompt = 'You are creating information about the subtopic called "' + name + '", a subtopic of the topic "' + self.topicsList[encoding] + '", which is a part of the lesson subject "' + self.lessonSubject + '". Keywords should be outputted in the format [<keyword 1>, <keyword 2>,...]. Nothing else should be outputted. Please create an exhaustive keyword list for the following lecture material:\n\n' + information
+
+            gptQuery = [{'role':'system','content':background},
+                        {'role':'user','content':prompt}]
+
+            with tracer.span("gpt.keywords", subtopic=name):
+                gptResponse = self.gptResponse(gptQuery)
+
+            bracketStart = gptResponse.find('[')
+            bracketEnd = gptResponse.find(']')
+            substring = gptResponse[bracketStart + 1:bracketEnd]
+            keywordList = substring.split(',')
+            for i in range(len(keywordList)):
+                keywordList[i] = keywordList[i].strip().lower()
+
+            return keywordList
+
+
+    ''' Create the actual lecture information file that Haystack will iterate through. This includes the keywords and the lecture material. The files are only rewritten when their content changes. '''
+    def createLectureInformationParseFile(self):
+        keywordFile = "generatedKeywords.json"
+        outFilePath = os.path.join(self.searchDirectory, "processedLectureMaterial.txt")
+        outMappingPath = os.path.join(self.supervisorDirectory, "lineToInformation.json")
+        outMapping = dict()
+
+        # Lines of the processed file and the line number -> subtopic identifiers, both kept in memory for retrieval
+        self.processedLines = []
+        self.lineToSubtopic = dict()
+
+        generatedKeywords = self.jsonToDict(keywordFile)
+        self.generatedKeywords = generatedKeywords
+
+        lineNumber = 1
+        for encoding in self.topicEncodings:
+            for subtopic in self.lectureMaterial[encoding]:
+                curKeywords = generatedKeywords[encoding][subtopic["name"]]
+
+                line = formatProcessedLine(subtopic["name"], curKeywords, subtopic["information"])
+
+                outMapping[lineNumber] = subtopic["information"]
+                self.processedLines.append(line)
+                self.lineToSubtopic[lineNumber] = (encoding, subtopic["name"])
+
+                lineNumber+=1
+
+        # The knowledge pack replaces these files
+        if not self.useKnowledgePack:
+            os.makedirs(self.searchDirectory, exist_ok=True)
+            self.writeFileIfChanged(outFilePath, "".join(line + '\n' for line in self.processedLines))
+            self.writeFileIfChanged(outMappingPath, json.dumps(outMapping))
+
+        # Line number -> information table used to map retrieval results back to lecture material
+        self.lineToInformation = outMapping
+
+
+    ''' Write a file only if its content would change, so unchanged lecture material does not touch the disk '''
+    def writeFileIfChanged(self, path: str, content: str):
+        if os.path.exists(path):
+            with open(path, 'r') as fh:
+                if fh.read() == content:
+                    return False
+
+        with open(path, 'w') as fh:
+            fh.write(content)
+
+        return True
+
+
+    def knowledgePackPath(self):
+        return os.path.join(self.indexDirectory, "knowledge.pack")
+
+
+    ''' Fingerprint of everything the knowledge pack is compiled from (the supervisor files, the generated keywords and the lesson subject) '''
+    def knowledgePackFingerprint(self):
+        sources = ["topicsList.json", "topicsInformationList.json", "lectureMaterial.json", "generatedKeywords.json"]
+        return sourceFingerprint([os.path.join(self.supervisorDirectory, fn) for fn in sources], self.lessonSubject)
+
+
+    ''' Compile the parsed supervisor files and generated keywords into the knowledge pack '''
+    def buildKnowledgePack(self):
+        KnowledgePack.build(self.knowledgePackPath(), self.knowledgePackFingerprint(), self.topicsList, self.topicsInformation, self.lectureMaterial, self.generatedKeywords)
+
+
+    ''' If the knowledge pack is enabled and up to date, read the lecture material from it instead of the parsed files. Returns False if it cannot be used. '''
+    def openKnowledgePack(self):
+        if not (self.useKnowledgePack and self.lectureMaterialIncluded and self.topicsListIncluded):
+            return False
+
+        pack = KnowledgePack.open(self.knowledgePackPath(), self.knowledgePackFingerprint())
+        if pack is None:
+            return False
+
+        self.knowledgePack = pack
+        self.topicsList = pack.topicsList()
+        self.topicEncodings = list(self.topicsList.keys())
+        self.topicsInformation = pack.topicsInformation() if self.topicsInformationIncluded else None
+        self.predefinedQuestions = None
+
+        # Read-only views that decode from the mapped file on access
+        self.lectureMaterial = PackLectureMaterial(pack)
+        self.generatedKeywords = PackGeneratedKeywords(pack)
+        self.processedLines = PackProcessedLines(pack)
+        self.lineToSubtopic = PackLines(pack, lambda lineNumber: (pack.subtopicEncoding(lineNumber), pack.subtopicName(lineNumber)))
+        self.lineToInformation = PackLines(pack, pack.subtopicInformation)
+
+        return True
+
+
+    ''' Build one document per processed line, carrying its line number and subtopic as metadata so retrieval results map straight back to the lecture material '''
+    def lectureMaterialDocuments(self):
+        return [{"content": line, "meta": self.lineMeta(index + 1)} for index, line in enumerate(self.processedLines)]
+
+
+    ''' The retrieval metadata of a processed line '''
+    def lineMeta(self, lineNumber: int):
+        encoding, name = self.lineToSubtopic[lineNumber]
+        return {"name": 'processedLectureMaterial.txt', "lineNumber": lineNumber, "encoding": encoding, "subtopic": name, "subtopicId": subtopicId(encoding, name)}
+
+
+    ''' Initializes Haystack from the KnowledgeBase Constructor. This code is adapted from https://github.com/deepset-ai/haystack/blob/main/examples/basic_qa_pipeline.py '''
+    def haystackInitialization(self):
+        if not self.lectureMaterialIncluded:
+            return
+
+        print("Initializing Haystack...")
+        importHaystack(self.retrievalBackend, self.retrievalMode)
+
+        if self.retrievalBackend == "inmemory":
+            self.inMemoryInitialization()
+            return
+
+        # Launch Elastic Search
+        with tracer.span("launch_es"):
+            launch_es()
+
+        document_store = ElasticsearchDocumentStore(host="localhost", username="", password="", index=self.indexName)
+
+        # Only (re)index the lines that changed since the last run
+        with tracer.span("indexing", backend=self.retrievalBackend):
+            self.updateDocumentStore(document_store)
+
+        # Initialize Retriever & Reader. Retrieval calls them directly instead of through a query pipeline, so that several queries are batched and
+        # queries without documents skip the reader (see retrievalPredictions).
+        self.retriever = BM25Retriever(document_store=document_store)
+
+        self.loadReader()
+
+
+    ''' Bring the document store up to date with the processed lecture material. A manifest in the course's HaystackIndex directory records a fingerprint and the line number of every indexed subtopic, keyed by its stable ID (topic encoding and subtopic name): indexing is skipped entirely when nothing changed, only new or changed subtopics are deleted and re-indexed, and subtopics that only moved to another line get their line number updated in place. '''
+    def updateDocumentStore(self, document_store):
+        manifest_path = os.path.join(self.indexDirectory, 'indexManifest.json')
+
+        # Changing any of these settings invalidates the whole index
+        preprocessorSettings = {"clean_whitespace": True,
+                                "clean_empty_lines": True,
+                                "split_length": 100,
+                                "split_overlap": 50,
+                                "split_respect_sentence_boundary": True}
+
+        manifest = None
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as fh:
+                manifest = json.load(fh)
+
+        # With a knowledge pack, an index built from the same pack is up to date without fingerprinting every line
+        packFingerprint = self.knowledgePack.fingerprint.hex() if self.knowledgePack is not None else None
+        if packFingerprint is not None and manifest is not None and manifest.get("knowledgePack") == packFingerprint and manifest["index"] == document_store.index and manifest["preprocessor"] == preprocessorSettings and document_store.get_document_count() > 0:
+            return
+
+        # One document per line of processedLectureMaterial.txt (one per subtopic), with the line number and subtopic attached as metadata. The line
+        # number is left out of the fingerprint, so inserting or removing a subtopic does not change the fingerprints of the subtopics after it.
+        lineDocuments = self.lectureMaterialDocuments()
+        indexEntries = dict()
+        for document in lineDocuments:
+            fingerprintedMeta = {name: value for name, value in document["meta"].items() if name != "lineNumber"}
+            fingerprint = hashlib.sha256(json.dumps({"content": document["content"], "meta": fingerprintedMeta}, sort_keys=True).encode('utf-8')).hexdigest()
+            indexEntries[document["meta"]["subtopicId"]] = {"fingerprint": fingerprint, "lineNumber": document["meta"]["lineNumber"]}
+
+        # Manifests keyed by line number (written before subtopic IDs were used) cannot be matched, so their index is rebuilt
+        fullRebuild = manifest is None or manifest.get("documentKey") != "subtopicId" or manifest["index"] != document_store.index or manifest["preprocessor"] != preprocessorSettings or document_store.get_document_count() == 0
+        if fullRebuild:
+            document_store.delete_documents()  # remove unrelated documents that were processed earlier
+            changedSubtopics = set(indexEntries.keys())
+        else:
+            indexed = manifest["documents"]
+            changedSubtopics = {subtopicId for subtopicId, entry in indexEntries.items() if subtopicId not in indexed or indexed[subtopicId]["fingerprint"] != entry["fingerprint"]}
+            removedSubtopics = {subtopicId for subtopicId in indexed if subtopicId not in indexEntries}
+            movedSubtopics = {subtopicId for subtopicId, entry in indexEntries.items() if subtopicId not in changedSubtopics and indexed[subtopicId]["lineNumber"] != entry["lineNumber"]}
+
+            if len(changedSubtopics) == 0 and len(removedSubtopics) == 0 and len(movedSubtopics) == 0:
+                if packFingerprint is not None and manifest.get("knowledgePack") != packFingerprint:
+                    self.writeIndexManifest(manifest_path, document_store, preprocessorSettings, indexEntries, packFingerprint)
+                return
+
+            # Remove the outdated splits of every changed or removed subtopic
+            if len(changedSubtopics | removedSubtopics) > 0:
+                document_store.delete_documents(filters={"subtopicId": list(changedSubtopics | removedSubtopics)})
+
+            # Unchanged subtopics on another line only need the line number of their splits updated
+            if len(movedSubtopics) > 0:
+                for split in document_store.get_all_documents(filters={"subtopicId": list(movedSubtopics)}, return_embedding=False):
+                    split.meta["lineNumber"] = indexEntries[split.meta["subtopicId"]]["lineNumber"]
+                    document_store.update_document_meta(split.id, split.meta)
+
+        documents = [Document(content=document["content"], meta=document["meta"]) for document in lineDocuments if document["meta"]["subtopicId"] in changedSubtopics]
+
+        if len(documents) > 0:
+            # Indexing Pipeline
+            indexing_pipeline = Pipeline()
+
+            # - Pre-processes the text by performing splits and adding metadata to the text (Preprocessor node)
+            preprocessor = PreProcessor(**preprocessorSettings)
+            indexing_pipeline.add_node(preprocessor, name="Preprocessor", inputs=["File"])
+
+            # - Writes the resulting documents into the document store
+            indexing_pipeline.add_node(document_store, name="Document_Store", inputs=["Preprocessor"])
+
+            # Then we run it with the documents and their metadata as input (the metadata is copied onto every split)
+            indexing_pipeline.run(documents=documents)
+
+        self.writeIndexManifest(manifest_path, document_store, preprocessorSettings, indexEntries, packFingerprint)
+
+
+    def writeIndexManifest(self, manifest_path, document_store, preprocessorSettings, indexEntries, packFingerprint):
+        os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+        with open(manifest_path, 'w') as fh:
+            json.dump({"index": document_store.index, "preprocessor": preprocessorSettings, "documentKey": "subtopicId", "documents": indexEntries, "knowledgePack": packFingerprint}, fh)
+
+
+    ''' In "reader" mode, use the process's shared FARMReader and its lock (see sharedReader), so that the reader is loaded once however many knowledge bases are built '''
+    def loadReader(self):
+        if self.retrievalMode == "reader":
+            self.reader, self.retrievalLock = sharedReader()
+        else:
+            self.reader = None
+
+
+    ''' Initializes the in-memory BM25 backend from haystackInitialization(). The index is persisted in the course's HaystackIndex directory and only rebuilt when the processed lecture material changes. '''
+    def inMemoryInitialization(self):
+        index_path = os.path.join(self.indexDirectory, 'bm25Index.json')
+
+        # The pack's fingerprint identifies the lines, which the index then references in the pack instead of copying them
+        if self.knowledgePack is not None:
+            lineDocuments = None
+            fingerprint = "knowledgePack:" + self.knowledgePack.fingerprint.hex()
+        else:
+            lineDocuments = self.lectureMaterialDocuments()
+            fingerprint = hashlib.sha256(json.dumps(lineDocuments, sort_keys=True).encode('utf-8')).hexdigest()
+
+        with tracer.span("indexing", backend=self.retrievalBackend) as span:
+            index = self.loadOrBuildInMemoryIndex(index_path, lineDocuments, fingerprint)
+            span.set(documents=len(index.documents))
+
+        self.bm25Index = index
+        self.loadReader()
+        self.retriever = None
+
+
+    ''' Load the persisted BM25 index, rebuilding (and saving) it if it is missing or was built from other lecture material. With a knowledge pack,
+        the passages are stored as references into the pack's lines (see PassageReferences), so the index file and every process loading it only
+        hold their offsets and the lecture material stays in the mapped pack. '''
+    def loadOrBuildInMemoryIndex(self, index_path, lineDocuments, fingerprint):
+        pack = self.knowledgePack
+        if pack is not None:
+            index = InMemoryBM25Index.load(index_path, readLine=pack.processedLine, readMeta=self.lineMeta)
+            # An index saved with the passage text (before passages were referenced) is rebuilt as well
+            if index is not None and not isinstance(index.documents, PassageReferences):
+                index = None
+        else:
+            index = InMemoryBM25Index.load(index_path)
+
+        if index is None or index.fingerprint != fingerprint:
+            # Split each line the same way the Elasticsearch PreProcessor does, keeping the line metadata on every passage
+            if pack is not None:
+                documents = PassageReferences(pack.processedLine, self.lineMeta)
+                for lineNumber in range(1, pack.subtopicCount + 1):
+                    for start, end in passageSpans(pack.processedLine(lineNumber), splitLength=100, splitOverlap=50):
+                        documents.append(lineNumber, start, end)
+            else:
+                if lineDocuments is None:
+                    lineDocuments = self.lectureMaterialDocuments()
+
+                documents = []
+                for lineDocument in lineDocuments:
+                    for passage in splitPassages(lineDocument["content"], splitLength=100, splitOverlap=50):
+                        documents.append({"content": passage, "meta": lineDocument["meta"]})
+
+            index = InMemoryBM25Index().build(documents)
+            index.fingerprint = fingerprint
+            index.save(index_path)
+
+        return index
+
+
+    ''' Runs a query through the retriever (and, in "reader" mode, the reader) of the selected backend, returning the Haystack prediction. In "retriever" mode the prediction only holds documents, and more candidates are retrieved so they can be re-ranked by line. '''
+    def retrievalPrediction(self, query, topK):
+        return self.retrievalPredictions([query], topK)[0]
+
+
+    ''' Runs several queries through the retriever and reader in one batch, returning one prediction per query. The retriever's and reader's batch
+        methods are used where this Haystack version has them. A query without any retrieved documents gets an empty prediction instead of being
+        passed to the reader. '''
+    def retrievalPredictions(self, queries, topK):
+        if self.retrievalMode == "retriever":
+            topK = topK * 3
+
+        with tracer.span("retrievalBatch", backend=self.retrievalBackend, mode=self.retrievalMode, queries=len(queries)):
+            with tracer.span("retriever", backend=self.retrievalBackend) as span:
+                if self.retrievalBackend == "inmemory":
+                    # Only the reader needs Haystack documents
+                    documentClass = Document if self.reader is not None else RetrievedDocument
+                    documentLists = [[documentClass(content=document["content"], meta=document["meta"], score=document["score"]) for document in documents]
+                                     for documents in self.bm25Index.retrieveBatch(queries, topK)]
+                elif hasattr(self.retriever, "retrieve_batch"):
+                    documentLists = self.retriever.retrieve_batch(queries=queries, top_k=topK)
+                else:
+                    documentLists = [self.retriever.retrieve(query=query, top_k=topK) for query in queries]
+
+                predictions = [{"query": query, "documents": documents} for query, documents in zip(queries, documentLists)]
+                span.set(documents=sum(len(prediction["documents"]) for prediction in predictions))
+
+            if self.reader is not None:
+                for prediction in predictions:
+                    prediction["answers"] = []
+
+                # Only queries that retrieved something are read
+                readable = [prediction for prediction in predictions if prediction["documents"]]
+                with tracer.span("reader", queries=len(readable)) as span:
+                    if readable and hasattr(self.reader, "predict_batch"):
+                        answerLists = self.reader.predict_batch(queries=[prediction["query"] for prediction in readable],
+                                                                documents=[prediction["documents"] for prediction in readable], top_k=topK)["answers"]
+                        for prediction, answers in zip(readable, answerLists):
+                            prediction["answers"] = answers
+                    else:
+                        for prediction in readable:
+                            prediction["answers"] = self.reader.predict(query=prediction["query"], documents=prediction["documents"], top_k=topK)["answers"]
+
+                    span.set(answers=sum(len(prediction["answers"]) for prediction in predictions))
+
+        return predictions
+
+
+    ''' Given a list of strings from the tutor (i..e the question and the answer), return the relevant lecture material. This is the overarching function that determines lecture material inclusion. Please note it calls all the functions that are defined below to accomplish its task. '''
+    def stringListToInformationHaystack(self,strList):
+        ''' From a list of strings, outputs all lines of relevant informaton determined by Haystack '''
+
+        lineSet = self.stringListToLineScores(strList)
+
+        # Line number -> information
+        outInformation = []
+        linesToAdd = list(lineSet)
+        linesToAdd.sort()
+        for line in linesToAdd:
+            outInformation.append(self.lineToInformation[line])
+
+        return outInformation
+
+
+    ''' From a list of strings, returns every relevant line number with its fused retrieval score. All strings are retrieved in one batch; each gives a
+        line the best score (0-1) of the reader's answers, or in "retriever" mode the retriever's documents, found on it, and a line's fused score is the
+        sum over the strings, so a line found by both the question and the answer ranks above one found by only one of them. '''
+    def stringListToLineScores(self,strList):
+        queries = [query for query in strList if query.strip()]
+        if not queries:
+            return dict()
+
+        # Only the reader needs to be serialized; the retrievers are safe to use concurrently
+        with self.retrievalLock if self.retrievalMode == "reader" else nullcontext():
+            predictions = self.retrievalPredictions(queries, 3)
+
+        lineScores = dict()
+        for prediction in predictions:
+            for lineNum, score in self.obtainLineScores(prediction).items():
+                lineScores[lineNum] = lineScores.get(lineNum, 0.0) + score
+
+        return lineScores
+
+
+    ''' Return the line numbers for the information that Haystack finds relevant. It takes this information in as an input. Multiple lines may be found as a result of the implementation. '''
+    def findLineNumber(self, context: str):
+        with tracer.span("findLineNumber") as span:
+            ls = []
+            for index, line in enumerate(self.processedLines):
+                if context in line:
+                    ls.append(1 + index)
+            span.set(hits=len(ls))
+
+        return ls
+
+
+    ''' Multiple outputs are likely to be given by Haystack. As a result, we choose to use every output to concatenate the relevant information and feed it all back for GPT concatenation.'''
+    def obtainLineNumber(self,prediction):
+        return list(self.obtainLineScores(prediction))
+
+    ''' The line numbers of a prediction, each with the best score of the answers (or, in "retriever" mode, documents) found on it '''
+    def obtainLineScores(self,prediction):
+        if "answers" not in prediction:
+            return dict(self.rankDocumentLines(prediction["documents"], 3))
+
+        answers = prediction["answers"]
+        outLineScores = dict()
+
+        for answer in answers:
+            # Documents are indexed with their line number as metadata; only fall back to searching the text if it is missing
+            if answer.meta is not None and "lineNumber" in answer.meta:
+                lineNumbers = [answer.meta["lineNumber"]]
+            else:
+                lineNumbers = self.findLineNumber(answer.context)
+
+            score = answer.score if answer.score is not None else 0.0
+            for lineNumber in lineNumbers:
+                outLineScores[lineNumber] = max(outLineScores.get(lineNumber, score), score)
+
+        return outLineScores
+
+
+    ''' Retrieval-only mode: re-rank the retrieved documents by the line they came from (a line scores as its best document, with the summed score breaking ties), drop lines below minRetrievalScore and keep the best (line number, score) pairs '''
+    def rankDocumentLines(self, documents, maxLines: int):
+        bestScores = dict()
+        totalScores = dict()
+        for document in documents:
+            lineNumber = document.meta["lineNumber"]
+            score = document.score if document.score is not None else 0.0
+            bestScores[lineNumber] = max(bestScores.get(lineNumber, score), score)
+            totalScores[lineNumber] = totalScores.get(lineNumber, 0.0) + score
+
+        if self.minRetrievalScore is not None:
+            bestScores = {lineNumber: score for lineNumber, score in bestScores.items() if score >= self.minRetrievalScore}
+
+        rankedLines = sorted(bestScores, key=lambda lineNumber: (bestScores[lineNumber], totalScores[lineNumber]), reverse=True)
+
+        return [(lineNumber, bestScores[lineNumber]) for lineNumber in rankedLines[:maxLines]]
+
+
+    ''' Given the question and answer, return the relevant lecture material found by Haystack (empty if the full KB is off) '''
+    def relatedLectureMaterial(self,question,answer):
+        if not self.lectureMaterialIncluded:
+            return []
+
+        return self.stringListToInformationHaystack([question,answer])
+
+
+    ''' Given the question and answer, return the relevant lecture material as candidates for context packing: each with its line number, text, best retrieval score and number of keyword hits '''
+    def relatedLectureMaterialCandidates(self,question,answer):
+        if not self.lectureMaterialIncluded:
+            return []
+
+        lineScores = self.stringListToLineScores([question,answer])
+
+        keywordHits = self.keywordMatcher.match(question, answer)
+
+        return [{"lineNumber": lineNumber,
+                 "text": self.lineToInformation[lineNumber],
+                 "retrievalScore": score,
+                 "keywordHits": keywordHits.get(lineNumber, 0)} for lineNumber, score in sorted(lineScores.items())]
@@ -0,0 +1,341 @@
+import hashlib
+import mmap
+import os
+import struct
+from collections.abc import Mapping, Sequence
+
+
+''' Binary layout (little-endian). Every section starts on an 8-byte boundary.
+    header:     magic, version, source fingerprint (SHA-256), topic/subtopic/string/keyword counts, section offsets
+    strings:    (offset into the pool, byte length) per string ID
+    pool:       the UTF-8 bytes of every distinct string (names, information, keywords), each stored once
+    topics:     (encoding, name, information) string IDs, first subtopic index, subtopic count
+    subtopics:  topic index, name and information string IDs, first keyword and count, first supervisor keyword and count
+    keywords:   string IDs, referenced by ranges from the subtopic table
+    Subtopics are stored in line order: subtopic index i is line number i + 1 of processedLectureMaterial.txt. '''
+packMagic = b"TUTORKP1"
+packVersion = 1
+headerFormat = struct.Struct("<8sI32sIIIIQQQQQ")
+stringFormat = struct.Struct("<QI")
+topicFormat = struct.Struct("<IIIII")
+subtopicFormat = struct.Struct("<IIIIIII")
+keywordFormat = struct.Struct("<I")
+
+# String ID of a missing string (e.g. a topic without information)
+noString = 0xFFFFFFFF
+
+
+''' The line a subtopic has in processedLectureMaterial.txt: its name, keywords and information '''
+def formatProcessedLine(name: str, keywords, information: str):
+    line = "\tTopic Name: " + name + "."
+
+    line += "\tTopic Keywords: ["
+    for keyword in keywords:
+        line += keyword + ", "
+    line += "].\t"
+
+    line += "Topic Information: " + information
+
+    return line
+
+
+''' Fingerprint of the files a pack is compiled from, so a stale pack is detected without parsing them '''
+def sourceFingerprint(paths, extra: str = ""):
+    digest = hashlib.sha256(extra.encode("utf-8"))
+    for path in paths:
+        digest.update(b"\0" + os.path.basename(path).encode("utf-8") + b"\0")
+        if os.path.exists(path):
+            with open(path, "rb") as fh:
+                for block in iter(lambda: fh.read(1 << 20), b""):
+                    digest.update(block)
+
+    return digest.digest()
+
+
+def align(offset: int):
+    return (offset + 7) & ~7
+
+
+class KnowledgePack:
+    ''' A compiled, read-only knowledge base: topics, subtopics, lecture material and keywords in one binary file with an offset table and an
+        interned string pool. It is opened with mmap, so nothing is parsed at startup and processes on the same host share its pages; strings are
+        only decoded when they are read (stringBytes() gives a zero-copy view). '''
+    def __init__(self, path: str):
+        self.path = path
+        self.fh = open(path, "rb")
+        self.buffer = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.buffer)
+
+        (magic, version, self.fingerprint, self.topicCount, self.subtopicCount, self.stringCount, self.keywordCount,
+         self.stringsOffset, self.poolOffset, self.topicsOffset, self.subtopicsOffset, self.keywordsOffset) = headerFormat.unpack_from(self.buffer, 0)
+
+        if magic != packMagic or version != packVersion:
+            self.close()
+            raise Exception("Not a knowledge pack (or an unsupported version): " + path)
+
+
+    ''' Open a pack, or return None if it does not exist or was compiled from other sources than the given fingerprint '''
+    @classmethod
+    def open(cls, path: str, fingerprint: bytes = None):
+        if not os.path.exists(path):
+            return None
+
+        try:
+            pack = cls(path)
+        except Exception:
+            return None
+
+        if fingerprint is not None and pack.fingerprint != fingerprint:
+            pack.close()
+            return None
+
+        return pack
+
+
+    ''' Compile a pack from the parsed supervisor files. topicsInformation may be None. The file is replaced atomically. '''
+    @staticmethod
+    def build(path: str, fingerprint: bytes, topicsList: dict, topicsInformation: dict, lectureMaterial: dict, generatedKeywords: dict):
+        stringIds = dict()
+        strings = []
+
+        def intern(text):
+            if text is None:
+                return noString
+            stringId = stringIds.get(text)
+            if stringId is None:
+                stringId = stringIds[text] = len(strings)
+                strings.append(text.encode("utf-8"))
+            return stringId
+
+        topics = []
+        subtopics = []
+        keywords = []
+        for topicIndex, encoding in enumerate(topicsList):
+            information = topicsInformation.get(encoding) if topicsInformation is not None else None
+            subtopicList = lectureMaterial.get(encoding, [])
+            topics.append((intern(encoding), intern(topicsList[encoding]), intern(information), len(subtopics), len(subtopicList)))
+
+            for subtopic in subtopicList:
+                generated = generatedKeywords.get(encoding, dict()).get(subtopic["name"], [])
+                supervisor = subtopic.get("keywords", [])
+
+                firstKeyword = len(keywords)
+                keywords.extend(intern(keyword) for keyword in generated)
+                firstSupervisorKeyword = len(keywords)
+                keywords.extend(intern(keyword) for keyword in supervisor)
+
+                subtopics.append((topicIndex, intern(subtopic["name"]), intern(subtopic["information"]), firstKeyword, len(generated), firstSupervisorKeyword, len(supervisor)))
+
+        # Section offsets
+        stringsOffset = align(headerFormat.size)
+        poolOffset = align(stringsOffset + stringFormat.size * len(strings))
+        poolSize = sum(len(data) for data in strings)
+        topicsOffset = align(poolOffset + poolSize)
+        subtopicsOffset = align(topicsOffset + topicFormat.size * len(topics))
+        keywordsOffset = align(subtopicsOffset + subtopicFormat.size * len(subtopics))
+        size = keywordsOffset + keywordFormat.size * len(keywords)
+
+        buffer = bytearray(size)
+        headerFormat.pack_into(buffer, 0, packMagic, packVersion, fingerprint, len(topics), len(subtopics), len(strings), len(keywords),
+                               stringsOffset, poolOffset, topicsOffset, subtopicsOffset, keywordsOffset)
+
+        position = 0
+        for stringId, data in enumerate(strings):
+            stringFormat.pack_into(buffer, stringsOffset + stringId * stringFormat.size, position, len(data))
+            buffer[poolOffset + position:poolOffset + position + len(data)] = data
+            position += len(data)
+
+        for i, topic in enumerate(topics):
+            topicFormat.pack_into(buffer, topicsOffset + i * topicFormat.size, *topic)
+        for i, subtopic in enumerate(subtopics):
+            subtopicFormat.pack_into(buffer, subtopicsOffset + i * subtopicFormat.size, *subtopic)
+        for i, keyword in enumerate(keywords):
+            keywordFormat.pack_into(buffer, keywordsOffset + i * keywordFormat.size, keyword)
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        temporaryPath = path + ".tmp"
+        with open(temporaryPath, "wb") as outfile:
+            outfile.write(buffer)
+        os.replace(temporaryPath, path)
+
+
+    def close(self):
+        if self.buffer is not None:
+            self.view.release()
+            self.buffer.close()
+            self.fh.close()
+            self.buffer = None
+
+
+    ''' The UTF-8 bytes of a string, as a view into the mapped file '''
+    def stringBytes(self, stringId: int):
+        if stringId == noString:
+            return None
+        offset, length = stringFormat.unpack_from(self.buffer, self.stringsOffset + stringId * stringFormat.size)
+        start = self.poolOffset + offset
+        return self.view[start:start + length]
+
+    def string(self, stringId: int):
+        if stringId == noString:
+            return None
+        return str(self.stringBytes(stringId), "utf-8")
+
+
+    ''' (encoding, name, information, first subtopic index, subtopic count) of a topic '''
+    def topic(self, topicIndex: int):
+        encodingId, nameId, informationId, firstSubtopic, subtopicCount = topicFormat.unpack_from(self.buffer, self.topicsOffset + topicIndex * topicFormat.size)
+        return self.string(encodingId), self.string(nameId), self.string(informationId), firstSubtopic, subtopicCount
+
+    def subtopicEntry(self, lineNumber: int):
+        if lineNumber < 1 or lineNumber > self.subtopicCount:
+            raise KeyError(lineNumber)
+        return subtopicFormat.unpack_from(self.buffer, self.subtopicsOffset + (lineNumber - 1) * subtopicFormat.size)
+
+    def keywordRange(self, first: int, count: int):
+        return [self.string(keywordFormat.unpack_from(self.buffer, self.keywordsOffset + (first + i) * keywordFormat.size)[0]) for i in range(count)]
+
+
+    ''' Subtopics are addressed by their line number (1-based) '''
+    def subtopicName(self, lineNumber: int):
+        return self.string(self.subtopicEntry(lineNumber)[1])
+
+    def subtopicInformation(self, lineNumber: int):
+        return self.string(self.subtopicEntry(lineNumber)[2])
+
+    def subtopicEncoding(self, lineNumber: int):
+        return self.topic(self.subtopicEntry(lineNumber)[0])[0]
+
+    def subtopicKeywords(self, lineNumber: int):
+        entry = self.subtopicEntry(lineNumber)
+        return self.keywordRange(entry[3], entry[4])
+
+    def subtopicSupervisorKeywords(self, lineNumber: int):
+        entry = self.subtopicEntry(lineNumber)
+        return self.keywordRange(entry[5], entry[6])
+
+    def processedLine(self, lineNumber: int):
+        entry = self.subtopicEntry(lineNumber)
+        return formatProcessedLine(self.string(entry[1]), self.keywordRange(entry[3], entry[4]), self.string(entry[2]))
+
+
+    ''' The topic-level dicts (topicsList, topicsInformation), which are small enough to be materialized '''
+    def topicsList(self):
+        return {encoding: name for encoding, name, _, _, _ in map(self.topic, range(self.topicCount))}
+
+    def topicsInformation(self):
+        return {encoding: information for encoding, _, information, _, _ in map(self.topic, range(self.topicCount))}
+
+
+class PackSubtopics(Sequence):
+    ''' The subtopics of one topic, read from the pack as {"name", "information"} dicts (like a topic's list in lectureMaterial.json) '''
+    def __init__(self, pack: KnowledgePack, firstSubtopic: int, subtopicCount: int):
+        self.pack = pack
+        self.firstSubtopic = firstSubtopic
+        self.subtopicCount = subtopicCount
+
+    def __len__(self):
+        return self.subtopicCount
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self.subtopicCount))]
+        if index < 0:
+            index += self.subtopicCount
+        if index < 0 or index >= self.subtopicCount:
+            raise IndexError(index)
+
+        lineNumber = self.firstSubtopic + index + 1
+        subtopic = {"name": self.pack.subtopicName(lineNumber), "information": self.pack.subtopicInformation(lineNumber)}
+        supervisorKeywords = self.pack.subtopicSupervisorKeywords(lineNumber)
+        if supervisorKeywords:
+            subtopic["keywords"] = supervisorKeywords
+        return subtopic
+
+
+class PackLectureMaterial(Mapping):
+    ''' encoding -> PackSubtopics, a read-only stand-in for the parsed lectureMaterial.json '''
+    def __init__(self, pack: KnowledgePack):
+        self.pack = pack
+        self.topicIndex = {pack.topic(i)[0]: i for i in range(pack.topicCount)}
+
+    def __getitem__(self, encoding):
+        _, _, _, firstSubtopic, subtopicCount = self.pack.topic(self.topicIndex[encoding])
+        return PackSubtopics(self.pack, firstSubtopic, subtopicCount)
+
+    def __iter__(self):
+        return iter(self.topicIndex)
+
+    def __len__(self):
+        return len(self.topicIndex)
+
+
+class PackTopicKeywords(Mapping):
+    ''' subtopic name -> generated keywords, for one topic '''
+    def __init__(self, pack: KnowledgePack, firstSubtopic: int, subtopicCount: int):
+        self.pack = pack
+        self.lineNumbers = {pack.subtopicName(lineNumber): lineNumber for lineNumber in range(firstSubtopic + 1, firstSubtopic + subtopicCount + 1)}
+
+    def __getitem__(self, name):
+        return self.pack.subtopicKeywords(self.lineNumbers[name])
+
+    def __iter__(self):
+        return iter(self.lineNumbers)
+
+    def __len__(self):
+        return len(self.lineNumbers)
+
+
+class PackGeneratedKeywords(Mapping):
+    ''' encoding -> subtopic name -> generated keywords, a read-only stand-in for the parsed generatedKeywords.json '''
+    def __init__(self, pack: KnowledgePack):
+        self.pack = pack
+        self.topicIndex = {pack.topic(i)[0]: i for i in range(pack.topicCount)}
+        self.topics = dict()
+
+    def __getitem__(self, encoding):
+        if encoding not in self.topics:
+            _, _, _, firstSubtopic, subtopicCount = self.pack.topic(self.topicIndex[encoding])
+            self.topics[encoding] = PackTopicKeywords(self.pack, firstSubtopic, subtopicCount)
+        return self.topics[encoding]
+
+    def __iter__(self):
+        return iter(self.topicIndex)
+
+    def __len__(self):
+        return len(self.topicIndex)
+
+
+class PackLines(Mapping):
+    ''' line number -> value read from the pack with the given function (e.g. lineToInformation, lineToSubtopic) '''
+    def __init__(self, pack: KnowledgePack, read):
+        self.pack = pack
+        self.read = read
+
+    def __getitem__(self, lineNumber):
+        if not isinstance(lineNumber, int):
+            raise KeyError(lineNumber)
+        return self.read(lineNumber)
+
+    def __iter__(self):
+        return iter(range(1, self.pack.subtopicCount + 1))
+
+    def __len__(self):
+        return self.pack.subtopicCount
+
+
+class PackProcessedLines(Sequence):
+    ''' The lines of processedLectureMaterial.txt (index 0 is line number 1), built from the pack when they are read '''
+    def __init__(self, pack: KnowledgePack):
+        self.pack = pack
+
+    def __len__(self):
+        return self.pack.subtopicCount
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError(index)
+        return self.pack.processedLine(index + 1)
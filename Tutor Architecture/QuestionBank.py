@@ -0,0 +1,125 @@
+import hashlib
+import json
+import os
+import threading
+
+from BatchEvaluator import JsonLinesWriter
+
+
+class QuestionBank:
+    ''' An on-disk bank of generated select-all-that-apply questions, one JSON line per subtopic. Every record is keyed by the content hash of what
+        its questions were generated from, so generation can resume where it stopped and only new or changed subtopics are regenerated. Records are
+        appended as soon as they are generated; when a key appears more than once, the last record wins. retain() drops the records that no longer
+        match the lecture material and compacts the file. '''
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.records = dict()   # key -> record
+        self.lineCount = 0      # records in the file, including superseded ones
+
+        if os.path.exists(path):
+            with open(path) as fh:
+                for line in fh:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue    # a line cut short by an interrupted run
+                    self.records[record["key"]] = record
+                    self.lineCount += 1
+
+        self.writer = JsonLinesWriter(path)
+
+
+    ''' The key of a subtopic's questions: a SHA-256 of everything that goes into its generation prompt '''
+    @staticmethod
+    def key(model: str, lessonSubject: str, topic: str, subtopic: str, information: str, questionCount: int):
+        content = json.dumps([model, lessonSubject, topic, subtopic, information, questionCount])
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+    ''' Where a course keeps its question bank '''
+    @staticmethod
+    def defaultPath(courseDirectory: str):
+        return os.path.join(courseDirectory, "QuestionBank", "questions.jsonl")
+
+
+    def get(self, key: str):
+        with self.lock:
+            return self.records.get(key)
+
+    def __contains__(self, key: str):
+        with self.lock:
+            return key in self.records
+
+    def __len__(self):
+        with self.lock:
+            return len(self.records)
+
+
+    ''' Store a subtopic's record (it must have a "key") and append it to the file at once '''
+    def add(self, record: dict):
+        with self.lock:
+            self.records[record["key"]] = record
+            self.writer.write(record)
+            self.lineCount += 1
+
+
+    ''' Keep only the records of the given keys (those of the current subtopics), dropping the questions of changed or removed subtopics and of other
+        models or question counts. If anything is dropped, or the file holds superseded records, it is rewritten with the kept records alone so that it
+        does not keep growing. Returns the number of dropped records. '''
+    def retain(self, keys):
+        keys = set(keys)
+        with self.lock:
+            stale = [key for key in self.records if key not in keys]
+            for key in stale:
+                del self.records[key]
+
+            if self.lineCount > len(self.records):
+                self.compact()
+
+        return len(stale)
+
+
+    ''' Rewrite the file with the current records (caller holds the lock). The new file replaces the old one at once, so an interrupted compaction loses nothing. '''
+    def compact(self):
+        self.writer.close()
+
+        temporaryPath = self.path + ".tmp"
+        with open(temporaryPath, "w") as outfile:
+            for record in self.records.values():
+                outfile.write(json.dumps(record) + "\n")
+        os.replace(temporaryPath, self.path)
+
+        self.writer = JsonLinesWriter(self.path)
+        self.lineCount = len(self.records)
+
+
+    ''' Every question of the bank, each with its topic and subtopic '''
+    def items(self):
+        with self.lock:
+            records = list(self.records.values())
+
+        return [dict(item, topic=record["topic"], subtopic=record["subtopic"]) for record in records for item in record["items"]]
+
+
+    ''' The questions in the question bank format of runme.py and evaluateTutors ({'q': question with its options, 'a': answer}). By default the
+        answer is the answer key, e.g. to check the tutors' ratings of correct answers. '''
+    def questionBank(self, answers: dict = None):
+        return [{"q": formatQuestion(item), "a": formatAnswer(item) if answers is None else answers.get(item["question"], "")} for item in self.items()]
+
+
+    def close(self):
+        self.writer.close()
+
+
+''' A question with its lettered options, as asked in runme.py: "<question> a) <option> b) <option> ..." '''
+def formatQuestion(item: dict):
+    return item["question"] + " " + " ".join(letter + ") " + item["options"][letter] for letter in sorted(item["options"]))
+
+
+''' The answer key of a question, e.g. "A, C" '''
+def formatAnswer(item: dict):
+    return ", ".join(letter.upper() for letter in item["answer"])
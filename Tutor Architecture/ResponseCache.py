@@ -0,0 +1,172 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import hashlib
+from collections import OrderedDict
+
+
+class ResponseCache:
+    ''' A content-addressed cache of GPT responses, keyed by the model and the canonicalized messages. It has an in-memory LRU tier in front of an
+        on-disk SQLite tier with size-based eviction and an optional time-to-live. Pass path=None for a memory-only cache. '''
+    def __init__(self, path: str = "./ResponseCache/responses.sqlite", memoryEntries: int = 1024, maxDiskBytes: int = 256 * 1024 * 1024, ttlSeconds: float = None, bypass: bool = False):
+        self.path = path
+        self.memoryEntries = memoryEntries
+        self.maxDiskBytes = maxDiskBytes
+        self.ttlSeconds = ttlSeconds
+
+        # If True, every lookup misses and nothing is stored
+        self.bypass = bypass
+
+        self.lock = threading.Lock()
+        self.memory = OrderedDict()   # key -> (creation time, response)
+
+        self.hits = 0
+        self.misses = 0
+        self.memoryHits = 0
+        self.diskHits = 0
+
+        self.connection = None
+        if path is not None:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+
+            self.connection = sqlite3.connect(path, check_same_thread=False)
+            self.connection.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, model TEXT, response TEXT, size INTEGER, createdAt REAL, accessedAt REAL)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS responsesAccessedAt ON responses (accessedAt)")
+            self.connection.commit()
+
+
+    ''' Build the cache key: a SHA-256 of the model and the messages serialized with sorted keys and no insignificant whitespace '''
+    @staticmethod
+    def key(model: str, messages):
+        canonical = json.dumps({"model": model, "messages": messages}, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+    ''' Return the cached response for this request, or None on a miss '''
+    def get(self, model: str, messages):
+        if self.bypass:
+            return None
+
+        key = self.key(model, messages)
+        now = time.time()
+
+        with self.lock:
+            if key in self.memory:
+                createdAt, response = self.memory[key]
+                if not self.isExpired(createdAt, now):
+                    self.memory.move_to_end(key)
+                    self.hits += 1
+                    self.memoryHits += 1
+                    return response
+                del self.memory[key]
+
+            if self.connection is not None:
+                row = self.connection.execute("SELECT response, createdAt FROM responses WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    response, createdAt = row
+                    if not self.isExpired(createdAt, now):
+                        self.connection.execute("UPDATE responses SET accessedAt = ? WHERE key = ?", (now, key))
+                        self.connection.commit()
+                        self.remember(key, createdAt, response)
+                        self.hits += 1
+                        self.diskHits += 1
+                        return response
+
+                    self.connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    self.connection.commit()
+
+            self.misses += 1
+            return None
+
+
+    ''' Store a response for this request in both tiers '''
+    def put(self, model: str, messages, response: str):
+        if self.bypass or response is None:
+            return
+
+        key = self.key(model, messages)
+        now = time.time()
+
+        with self.lock:
+            self.remember(key, now, response)
+
+            if self.connection is not None:
+                self.connection.execute("INSERT OR REPLACE INTO responses (key, model, response, size, createdAt, accessedAt) VALUES (?, ?, ?, ?, ?, ?)",
+                                        (key, model, response, len(response.encode("utf-8")), now, now))
+                self.evict(now)
+                self.connection.commit()
+
+
+    ''' Remove the response stored for this request, e.g. when the caller could not use it, so that it is requested again next time '''
+    def delete(self, model: str, messages):
+        key = self.key(model, messages)
+
+        with self.lock:
+            self.memory.pop(key, None)
+            if self.connection is not None:
+                self.connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.connection.commit()
+
+
+    ''' Hit/miss counters and tier sizes '''
+    def stats(self):
+        with self.lock:
+            diskEntries, diskBytes = 0, 0
+            if self.connection is not None:
+                diskEntries, diskBytes = self.connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "memoryHits": self.memoryHits,
+                    "diskHits": self.diskHits,
+                    "memoryEntries": len(self.memory),
+                    "diskEntries": diskEntries,
+                    "diskBytes": diskBytes}
+
+
+    ''' Remove every cached response '''
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+            if self.connection is not None:
+                self.connection.execute("DELETE FROM responses")
+                self.connection.commit()
+
+
+    def close(self):
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
+
+    def isExpired(self, createdAt: float, now: float):
+        return self.ttlSeconds is not None and now - createdAt > self.ttlSeconds
+
+
+    ''' Add to the memory tier, dropping the least recently used entries beyond its capacity (caller holds the lock) '''
+    def remember(self, key: str, createdAt: float, response: str):
+        self.memory[key] = (createdAt, response)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memoryEntries:
+            self.memory.popitem(last=False)
+
+
+    ''' Drop expired rows, then the least recently used rows until the disk tier fits in maxDiskBytes (caller holds the lock) '''
+    def evict(self, now: float):
+        if self.ttlSeconds is not None:
+            self.connection.execute("DELETE FROM responses WHERE createdAt < ?", (now - self.ttlSeconds,))
+
+        totalBytes = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if totalBytes <= self.maxDiskBytes:
+            return
+
+        for key, size in self.connection.execute("SELECT key, size FROM responses ORDER BY accessedAt ASC").fetchall():
+            if totalBytes <= self.maxDiskBytes:
+                break
+            self.connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+            totalBytes -= size
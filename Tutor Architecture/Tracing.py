@@ -0,0 +1,217 @@
+import itertools
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from BatchEvaluator import JsonLinesWriter
+
+
+class Span:
+    ''' A timed stage of the pipeline. Attributes (e.g. token or hit counts) can be added while it runs with set(). '''
+    def __init__(self, tracer, name: str, attributes: dict):
+        self.tracer = tracer
+        self.name = name
+        self.attributes = attributes
+        self.spanId = next(tracer.spanIds)
+        self.parentId = None
+        self.startTime = None
+        self.duration = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+        return self
+
+    def __enter__(self):
+        stack = self.tracer.stack()
+        self.parentId = stack[-1].spanId if stack else None
+        stack.append(self)
+        self.startTime = time.time()
+        self.startCounter = time.perf_counter()
+        return self
+
+    def __exit__(self, excType, exc, traceback):
+        self.duration = time.perf_counter() - self.startCounter
+        if excType is not None:
+            self.attributes["error"] = excType.__name__
+
+        stack = self.tracer.stack()
+        if stack and stack[-1] is self:
+            stack.pop()
+
+        self.tracer.finish(self)
+        return False
+
+    def record(self):
+        return {"name": self.name,
+                "spanId": self.spanId,
+                "parentId": self.parentId,
+                "thread": threading.current_thread().name,
+                "start": self.startTime,
+                "duration": self.duration,
+                "attributes": self.attributes}
+
+
+class NoOpSpan:
+    ''' Returned by a disabled tracer, so instrumented code costs one method call per stage '''
+    def set(self, **attributes):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, exc, traceback):
+        return False
+
+
+noOpSpan = NoOpSpan()
+
+
+class Tracer:
+    ''' Timing spans around the stages of the tutor pipeline (launch_es, indexing, retriever, reader, findLineNumber, the GPT requests...). Finished spans,
+        with their attributes (token counts, retrieval hits), are handed to every exporter. Tracing is off until enable() is called. '''
+    def __init__(self):
+        self.enabled = False
+        self.exporters = []
+        self.spanIds = itertools.count(1)
+        self.local = threading.local()
+
+
+    ''' Turn tracing on, sending finished spans to the given exporters '''
+    def enable(self, *exporters):
+        self.exporters = list(exporters)
+        self.enabled = True
+        return self
+
+    def disable(self):
+        self.enabled = False
+        for exporter in self.exporters:
+            exporter.close()
+        self.exporters = []
+
+
+    ''' A span for the stage with the given name, to be used in a with block '''
+    def span(self, name: str, **attributes):
+        if not self.enabled:
+            return noOpSpan
+
+        return Span(self, name, attributes)
+
+
+    ''' The spans open on this thread, innermost last '''
+    def stack(self):
+        stack = getattr(self.local, "stack", None)
+        if stack is None:
+            stack = self.local.stack = []
+        return stack
+
+
+    def finish(self, span: Span):
+        for exporter in self.exporters:
+            exporter.export(span)
+
+
+class JsonLinesSpanExporter:
+    ''' Appends every finished span as a JSON line to a file '''
+    def __init__(self, path: str = "trace.jsonl"):
+        self.writer = JsonLinesWriter(path)
+
+    def export(self, span: Span):
+        self.writer.write(span.record())
+
+    def close(self):
+        self.writer.close()
+
+
+class PrometheusExporter:
+    ''' Aggregates finished spans into Prometheus metrics: a latency histogram per span name, and a counter per numeric span attribute (e.g.
+        promptTokens, completionTokens, hits). snapshot() renders them in the Prometheus text format; serve() exposes it at http://host:port/metrics. '''
+    buckets = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self, prefix: str = "tutor"):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.histograms = dict()    # span name -> [bucket counts..., count, sum]
+        self.counters = dict()      # (span name, attribute) -> total
+        self.server = None
+
+
+    def export(self, span: Span):
+        with self.lock:
+            histogram = self.histograms.get(span.name)
+            if histogram is None:
+                histogram = self.histograms[span.name] = [0] * len(self.buckets) + [0, 0.0]
+
+            for i, bound in enumerate(self.buckets):
+                if span.duration <= bound:
+                    histogram[i] += 1
+            histogram[-2] += 1
+            histogram[-1] += span.duration
+
+            for attribute, value in span.attributes.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    key = (span.name, attribute)
+                    self.counters[key] = self.counters.get(key, 0) + value
+
+
+    ''' The current metrics in the Prometheus text exposition format '''
+    def snapshot(self):
+        lines = []
+        with self.lock:
+            name = self.prefix + "_span_seconds"
+            lines.append("# HELP " + name + " Duration of the tutor pipeline stages.")
+            lines.append("# TYPE " + name + " histogram")
+            for spanName, histogram in sorted(self.histograms.items()):
+                label = 'span="' + escapeLabel(spanName) + '"'
+                for bound, count in zip(self.buckets, histogram):
+                    lines.append(name + '_bucket{' + label + ',le="' + str(bound) + '"} ' + str(count))
+                lines.append(name + '_bucket{' + label + ',le="+Inf"} ' + str(histogram[-2]))
+                lines.append(name + "_count{" + label + "} " + str(histogram[-2]))
+                lines.append(name + "_sum{" + label + "} " + repr(histogram[-1]))
+
+            name = self.prefix + "_span_attribute_total"
+            lines.append("# HELP " + name + " Sum of a numeric span attribute (token counts, retrieval hits...).")
+            lines.append("# TYPE " + name + " counter")
+            for (spanName, attribute), total in sorted(self.counters.items()):
+                lines.append(name + '{span="' + escapeLabel(spanName) + '",attribute="' + escapeLabel(attribute) + '"} ' + str(total))
+
+        return "\n".join(lines) + "\n"
+
+
+    ''' Serve the snapshot at http://host:port/metrics from a background thread '''
+    def serve(self, port: int = 9464, host: str = "127.0.0.1"):
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+
+                data = exporter.snapshot().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def close(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+def escapeLabel(value: str):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+# The tracer used by every module of the tutor. Example: tracer.enable(JsonLinesSpanExporter("trace.jsonl"), PrometheusExporter().serve(9464))
+tracer = Tracer()
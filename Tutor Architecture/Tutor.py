@@ -1,27 +1,20 @@
 import openai
 import json
-import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-
-import logging
-from pathlib import Path
-
-logging.basicConfig(format="%(levelname)s - %(name)s -  %(message)s", level=logging.WARNING)
-logging.getLogger("haystack").setLevel(logging.INFO)
-
-# You will need pip install 'farm-haystack[all]' to obtain Haystack dependencies; this will take a couple of minutes.
-from haystack.document_stores import ElasticsearchDocumentStore
-from haystack.utils import fetch_archive_from_http, print_answers, launch_es
-from haystack.nodes import FARMReader, BM25Retriever
-from haystack.nodes.file_classifier import FileTypeClassifier
-from haystack.nodes.preprocessor import PreProcessor
-from haystack.nodes.file_converter import TextConverter
-from haystack.pipelines import Pipeline
+from BatchEvaluator import evaluateTutors
+from ResponseCache import ResponseCache
+from ChatClient import chatCompletion, StreamedCompletion, OpenAIClient
+from KnowledgeBase import KnowledgeBase
+from ContextPacker import ContextPacker, lectureMaterialTemplate
+from QuestionBank import QuestionBank, formatQuestion, formatAnswer
+from Tracing import tracer
 
 
 class Tutor:
     ''' Define the intelligent tutor and its aspects'''
-    def __init__(self, API_KEY: str = None, studentName: str = None, lessonSubject: str = None, model: int = None, topicsInformationIncluded: bool = False, lectureMaterialIncluded: bool = False):
+    def __init__(self, API_KEY: str = None, studentName: str = None, lessonSubject: str = None, model: int = None, topicsInformationIncluded: bool = False, lectureMaterialIncluded: bool = False, retrievalBackend: str = "elasticsearch", responseCache: ResponseCache = None, keywordWorkers: int = 4, retrievalMode: str = "reader", knowledgeBase: KnowledgeBase = None, combinedRating: bool = False, packContext: bool = False, contextTokenBudget: int = None, openAIClient: OpenAIClient = None):
         ''' OpenAI API Key '''
         # Saves API key, if present
         if API_KEY is None:
@@ -37,9 +30,30 @@ class Tutor:
         elif model == 4:
             self.model = "gpt-4-0314"
 
+        ''' GPT Response Cache '''
+        # If given, identical GPT requests are answered from the cache instead of the OpenAI API (may be shared between tutors)
+        self.responseCache = responseCache
+
+        ''' OpenAI Client '''
+        # Rate limits, retries and connection pooling of the GPT requests (may be shared between tutors so they share the rate limits)
+        self.openAIClient = openAIClient
+
+
+        ''' Combined Rating & Feedback '''
+        # If True, answerRating obtains the rating and the feedback in one structured (JSON) GPT response instead of two sequential requests
+        self.combinedRating = combinedRating
+
+        ''' Context Packing '''
+        # If True, the retrieved lecture material is ranked, deduplicated and trimmed to fit a token budget (by default, the model's entry in
+        # ContextPacker.modelContextBudgets) before it is added to the GPT requests
+        self.contextPacker = ContextPacker(self.model, contextTokenBudget) if packContext else None
+
 
         ''' Knowledge Base Depth Parameters '''
-        # Saves lesson subject, if present
+        # Saves lesson subject, if present (a shared knowledge base provides it otherwise)
+        if lessonSubject is None and knowledgeBase is not None:
+            lessonSubject = knowledgeBase.lessonSubject
+
         if lessonSubject is None:
             raise Exception("No lesson subject is present")
         else:
@@ -63,62 +77,48 @@ class Tutor:
         self.lectureMaterialIncluded = lectureMaterialIncluded
 
 
-        # Checks to ensure the subtopics list is reflected correctly in the lectureMaterial.txt file
-        self.supervisorFileReading()
-
-
-        ''' Keywords File Creation & Lecture Material Processing'''
-        self.createKeywordsFile()
+        ''' Knowledge Base '''
+        # A knowledge base may be shared by many tutors (e.g. one tutor per student). If none is given, one is built for this tutor alone.
+        if knowledgeBase is None and (topicsInformationIncluded or lectureMaterialIncluded):
+            knowledgeBase = KnowledgeBase(API_KEY=API_KEY, lessonSubject=lessonSubject, model=model, topicsInformationIncluded=topicsInformationIncluded, lectureMaterialIncluded=lectureMaterialIncluded, retrievalBackend=retrievalBackend, responseCache=responseCache, keywordWorkers=keywordWorkers, retrievalMode=retrievalMode, openAIClient=openAIClient)
+        self.knowledgeBase = knowledgeBase
 
-        ''' Haystack Initialization '''
-        self.haystackInitialization()
+        # Takes the supervisor information this tutor may use from the knowledge base
+        self.supervisorFileReading()
         print("Done!")
 
 
-    ''' Read the supervisor files given '''
+    ''' Read the supervisor information this tutor is allowed to use from its knowledge base. Nothing is copied, so tutors sharing a knowledge base share its memory. '''
     def supervisorFileReading(self):
-        ''' Read supervisor files and extract information from them '''
-
-
         ''' Create placeholders for potential information '''
         self.topicEncodings = None
         self.topicsList = None
+        self.topicsInformation = None
         self.lectureMaterial = None
+        self.keywordMatcher = None
         self.predefinedQuestions = None
 
-        ''' Extract necessary information '''
-        if self.topicsListIncluded:
-            self.topicsList = self.jsonToDict('topicsList.json')
-            self.topicEncodings = list(self.topicsList.keys())
-
-        if self.topicsInformationIncluded:
-            self.topicsInformation = self.jsonToDict('topicsInformationList.json')
+        if self.knowledgeBase is None:
+            return
 
-        if self.lectureMaterialIncluded:
-            self.lectureMaterial = self.jsonToDict('lectureMaterial.json')
+        ''' Ensure the knowledge base covers this tutor '''
+        if self.topicsInformationIncluded and not self.knowledgeBase.topicsInformationIncluded:
+            raise Exception("The knowledge base does not include the topics information.")
 
+        if self.lectureMaterialIncluded and not self.knowledgeBase.lectureMaterialIncluded:
+            raise Exception("The knowledge base does not include the lecture material.")
 
-        ''' Ensure proper formatting '''
+        ''' Extract necessary information '''
         if self.topicsListIncluded:
-            for encoding in self.topicEncodings:
-                if self.topicsInformationIncluded and encoding not in self.topicsInformation:
-                    raise Exception('Encoding "' + encoding + '" is not present in topicsInformationList.json file.')
-
-                if self.lectureMaterialIncluded and encoding not in self.lectureMaterial:
-                    raise Exception('Encoding "' + encoding + '" is not present in lectureMaterial.json file.')
-
+            self.topicsList = self.knowledgeBase.topicsList
+            self.topicEncodings = self.knowledgeBase.topicEncodings
 
-    ''' Convert a json file from the Supervisor folder into a dict '''
-    def jsonToDict(self,fn: str = None):
-        if fn is None:
-            return None
-
-        # Convert the json file into a dictionary
-        fh = open("./SupervisorFiles/" + fn)
-        outputDict = json.load(fh)
-        fh.close()
+        if self.topicsInformationIncluded:
+            self.topicsInformation = self.knowledgeBase.topicsInformation
 
-        return outputDict
+        if self.lectureMaterialIncluded:
+            self.lectureMaterial = self.knowledgeBase.lectureMaterial
+            self.keywordMatcher = self.knowledgeBase.keywordMatcher
 
 
     ''' Create the main tutor prompt used '''
@@ -145,44 +145,263 @@ class Tutor:
 
         return learningStagePrompt
 
-    def gptResponse(self,concatenatedConversation = None):
+
+    def gptResponse(self,concatenatedConversation = None, bypassCache: bool = False):
         ''' Returns a GPT generated response to the given conversation '''
 
         if concatenatedConversation is None:
             return None
 
-        completedConversation = openai.ChatCompletion.create(model=self.model, messages=concatenatedConversation)
+        return chatCompletion(self.model, concatenatedConversation, self.responseCache, bypassCache, self.openAIClient).replace("\n"," ")
 
-        return completedConversation['choices'][0]['message']['content'].replace("\n"," ")
+    ''' Drop a cached reply that could not be used, so the request is sent again instead of failing the same way on every run '''
+    def forgetResponse(self,concatenatedConversation):
+        if self.responseCache is not None:
+            self.responseCache.delete(self.model, concatenatedConversation)
 
+    def gptResponseStream(self,concatenatedConversation = None, bypassCache: bool = False, onComplete = None):
+        ''' Returns a StreamedCompletion that yields the GPT generated response to the given conversation token by token '''
 
-    ''' Create questions about the lecture material '''
-    def questionCreator(self):
+        if concatenatedConversation is None:
+            return None
+
+        return StreamedCompletion(self.model, concatenatedConversation, self.responseCache, bypassCache, flattenNewlines=True, onComplete=onComplete, client=self.openAIClient)
+
+
+    ''' Create select-all-that-apply questions about the lecture material, with their answer key. Subtopics are generated concurrently (up to
+        maxWorkers GPT requests at a time) and every subtopic's questions are appended to the question bank at questionBankPath as soon as they are
+        parsed (by default QuestionBank/questions.jsonl in the course directory). Subtopics whose content is unchanged since their questions were
+        stored are not regenerated, so an interrupted run resumes where it stopped, and the questions of any other subtopic are dropped from the bank.
+        Returns one record per subtopic, in lecture order: its topic, subtopic, key and parsed items (or the error that prevented them).
+        A long-lived caller (see TutorService) can pass an open questionBank, which is left open, and an executor shared by all its calls, which
+        then bounds their GPT requests together instead of maxWorkers. With verbose, every generated subtopic's questions are also printed. '''
+    def questionCreator(self, questionCount: int = 3, maxWorkers: int = 4, questionBankPath: str = None, maxRetries: int = 1, questionBank: QuestionBank = None, executor: ThreadPoolExecutor = None, verbose: bool = True):
         # if no lecture material, error!
         if not self.lectureMaterialIncluded:
             raise Exception("No lecture material is included! This cannot occur!")
 
-        mainPrompt = self.createMainTutorPrompt()
+        ownQuestionBank = questionBank is None
+        if ownQuestionBank:
+            questionBank = QuestionBank(questionBankPath if questionBankPath is not None else QuestionBank.defaultPath(self.knowledgeBase.courseDirectory))
+
+        ownExecutor = executor is None
+        if ownExecutor:
+            executor = ThreadPoolExecutor(max_workers=maxWorkers)
 
-        questionCount = "three"
+        # The prompt is the same for every subtopic
+        mainPrompt = self.createMainTutorPrompt()
 
+        subtopics = []
         for encoding in self.topicEncodings:
             for subtopic in self.lectureMaterial[encoding]:
-                gptQuery = [{'role': 'system', 'content': mainPrompt},
-                            {'role': 'user',
-                             'content': f"Please create " + questionCount + ", difficult questions within the subtopic, " + subtopic["name"] + ", within the topic " + self.topicsList[encoding] + " about the lecture material. All questions choosen should be of the type, ""select all that apply"". The questions may ONLY pertain to the following lecture material: \n\n" + subtopic["information"]},
-                            ]
+                key = QuestionBank.key(self.model, self.lessonSubject, self.topicsList[encoding], subtopic["name"], subtopic["information"], questionCount)
+                subtopics.append((key, encoding, subtopic["name"], subtopic["information"]))
 
-                gptResponse = self.gptResponse(gptQuery)
+        # Questions of subtopics that changed or are gone, or of another model or question count, are dropped from the bank (and its file)
+        questionBank.retain(key for key, _, _, _ in subtopics)
+
+        records = dict()
+        try:
+            toGenerate = []
+            for key, encoding, name, information in subtopics:
+                if key in questionBank:
+                    records[key] = questionBank.get(key)
+                else:
+                    toGenerate.append((key, encoding, name, information))
+
+            futures = {executor.submit(self.createSubtopicQuestions, mainPrompt, encoding, name, information, questionCount, maxRetries): (key, encoding, name)
+                       for key, encoding, name, information in toGenerate}
+
+            for future in as_completed(futures):
+                key, encoding, name = futures[future]
+                record = {"key": key, "topic": self.topicsList[encoding], "subtopic": name, "model": self.model}
+                try:
+                    record["items"] = future.result()
+                except Exception as e:
+                    # Not stored, so the next run tries this subtopic again
+                    record["items"] = []
+                    record["error"] = str(e)
+                    records[key] = record
+                    continue
+
+                questionBank.add(record)
+                records[key] = record
+
+                if verbose:
+                    print("For subtopic " + name + ", here are the questions generated: ")
+                    for item in record["items"]:
+                        print(formatQuestion(item) + " (answer: " + formatAnswer(item) + ")")
+                    print("\n\n")
+        finally:
+            if ownExecutor:
+                executor.shutdown()
+            if ownQuestionBank:
+                questionBank.close()
+
+        return [records[key] for key, _, _, _ in subtopics]
+
+
+    ''' Generate and parse the questions of one subtopic. A reply that cannot be parsed is retried with a correction. '''
+    def createSubtopicQuestions(self, mainPrompt, encoding, name, information, questionCount: int, maxRetries: int = 1):
+        itemFormat = '{"question": "<question>", "options": {"a": "<option>", "b": "<option>", "c": "<option>", "d": "<option>"}, "answer": [<the letters of every correct option>]}'
+
+        gptQuery = [{'role': 'system', 'content': mainPrompt},
+                    {'role': 'user',
+                     'content': "Please create " + str(questionCount) + ", difficult questions within the subtopic, " + name + ", within the topic " + self.topicsList[encoding] + " about the lecture material. All questions choosen should be of the type, \"select all that apply\", with four options of which at least one is correct. Reply with ONLY a JSON array of " + str(questionCount) + " objects of the form " + itemFormat + " and nothing else. The questions may ONLY pertain to the following lecture material: \n\n" + information},
+                    ]
+
+        items, _ = self.parsedGptResponse(gptQuery, self.parseQuestionItems, "a JSON array of objects of the form " + itemFormat, "gpt.questions", maxRetries, subtopic=name)
+        return items
+
+
+    ''' Strictly parse generated questions: a JSON array (a surrounding markdown code fence is tolerated) of objects with a question, lettered options and a non-empty answer key made of option letters. Anything else raises an exception. '''
+    def parseQuestionItems(self,response):
+        parsed = self.parseJsonResponse(response)
+
+        if not isinstance(parsed, list) or len(parsed) == 0:
+            raise Exception("GPT Response was not a JSON array of questions. The output was:" + response)
+
+        items = []
+        for item in parsed:
+            if not isinstance(item, dict) or not isinstance(item.get("question"), str) or item["question"].strip() == "":
+                raise Exception("GPT Response contained a question without any text. The output was:" + response)
+
+            options = item.get("options")
+            if not isinstance(options, dict) or len(options) < 2 or not all(isinstance(option, str) and option.strip() for option in options.values()):
+                raise Exception("GPT Response contained a question without lettered options. The output was:" + response)
+            options = {str(letter).strip().lower(): option.strip() for letter, option in options.items()}
+
+            answer = item.get("answer")
+            if isinstance(answer, str):
+                answer = answer.replace(",", " ").split()
+            if not isinstance(answer, list) or len(answer) == 0:
+                raise Exception("GPT Response contained a question without an answer key. The output was:" + response)
+            answer = sorted({str(letter).strip().lower() for letter in answer})
+            if any(letter not in options for letter in answer):
+                raise Exception("GPT Response contained an answer key that does not match the options. The output was:" + response)
 
-                print("For subtopic " + subtopic["name"] + ", here are the questions generated: ")
-                print(gptResponse)
-                print("\n\n")
+            items.append({"question": item["question"].strip(), "options": options, "answer": answer})
+
+        return items
 
 
     ''' The answer rating function. This is the only function needed to be ran by the programmer in order to have an intelligent assess a question-answer pair'''
     def answerRating(self,question,answer):
+        result = self.answerRatingResult(question, answer)
+
+        print("Athena: " + result["feedback"])
+
+        return result
+
+
+    ''' Rate many question-answer pairs concurrently. Pairs may be (question, answer) tuples or {'q': question, 'a': answer} dicts, as in runme.py. Results are returned in input order and, if an output path is given, appended to a JSONL file as they complete. '''
+    def rateMany(self, pairs, maxWorkers: int = 4, outputPath: str = None):
+        return evaluateTutors({"tutor": self}, pairs, maxWorkers=maxWorkers, outputPath=outputPath)["tutor"]
+
+
+    ''' Assess a question-answer pair and return the rating, feedback, retrieved lecture material and per-stage timings instead of printing them '''
+    def answerRatingResult(self,question,answer):
+        with tracer.span("answerRating", model=self.model, combinedRating=self.combinedRating):
+            return self.tracedAnswerRatingResult(question, answer)
+
+
+    def tracedAnswerRatingResult(self,question,answer):
+        timings = dict()
+        startTime = time.perf_counter()
+
+        relatedInformation, finalAdditionList, contextTokens = self.retrievalStage(question, answer, timings)
+
+        if self.combinedRating:
+            result = self.combinedAnswerRatingResult(question, answer, relatedInformation, finalAdditionList, timings, startTime)
+            result["contextTokens"] = contextTokens
+            return result
+
         # Part 1: the internal ranking
+        rating, ratingGptResponse = self.ratingStage(question, answer, finalAdditionList, timings)
+
+        # Part 2: the response to the student
+        gptQuery = self.feedbackQuery(question, answer, rating, finalAdditionList)
+
+        stageTime = time.perf_counter()
+        with tracer.span("gpt.feedback"):
+            gptResponse = self.gptResponse(gptQuery)
+        timings["feedback"] = time.perf_counter() - stageTime
+
+        timings["total"] = time.perf_counter() - startTime
+
+        return {"question": question,
+                "answer": answer,
+                "rating": rating,
+                "ratingResponse": ratingGptResponse,
+                "feedback": gptResponse,
+                "retrievedPassages": relatedInformation,
+                "contextTokens": contextTokens,
+                "timings": timings}
+
+
+    ''' Assess a question-answer pair, streaming the feedback to the student. The retrieval and the internal rating are done first; the returned
+        StreamedCompletion then yields the feedback token by token. The returned result dict is completed (feedback, timeToFirstToken and total time)
+        once the stream has been consumed. '''
+    def answerRatingStream(self,question,answer):
+        # The span covers the retrieval, the rating and opening the feedback stream; the tokens are yielded after it closes
+        with tracer.span("answerRating", model=self.model, combinedRating=self.combinedRating, stream=True):
+            return self.tracedAnswerRatingStream(question, answer)
+
+
+    def tracedAnswerRatingStream(self,question,answer):
+        timings = dict()
+        startTime = time.perf_counter()
+
+        relatedInformation, finalAdditionList, contextTokens = self.retrievalStage(question, answer, timings)
+
+        rating, ratingGptResponse = self.ratingStage(question, answer, finalAdditionList, timings)
+
+        result = {"question": question,
+                  "answer": answer,
+                  "rating": rating,
+                  "ratingResponse": ratingGptResponse,
+                  "feedback": None,
+                  "retrievedPassages": relatedInformation,
+                  "contextTokens": contextTokens,
+                  "timings": timings}
+
+        def onComplete(stream):
+            result["feedback"] = stream.text
+            timings["feedbackFirstToken"] = stream.timeToFirstToken
+            timings["feedback"] = stream.totalTime
+            timings["total"] = time.perf_counter() - startTime
+
+        stream = self.gptResponseStream(self.feedbackQuery(question, answer, rating, finalAdditionList), onComplete=onComplete)
+
+        # Time from the start of the assessment until the stream was ready to deliver feedback
+        timings["beforeFeedback"] = time.perf_counter() - startTime
+
+        return result, stream
+
+
+    ''' Retrieve the lecture material for a question-answer pair, packing it into the token budget if context packing is on. Returns the lecture material, its GPT messages and the number of tokens they use (None when context packing is off). '''
+    def retrievalStage(self,question,answer,timings):
+        stageTime = time.perf_counter()
+
+        contextTokens = None
+        with tracer.span("retrieval") as span:
+            if self.contextPacker is not None and self.lectureMaterialIncluded:
+                packed = self.contextPacker.pack(self.knowledgeBase.relatedLectureMaterialCandidates(question, answer), question, answer)
+                relatedInformation = packed["passages"]
+                contextTokens = packed["tokens"]
+                span.set(candidates=packed["candidates"], contextTokens=contextTokens)
+            else:
+                relatedInformation = self.relatedLectureMaterial(question, answer)
+            span.set(hits=len(relatedInformation))
+
+        finalAdditionList = self.lectureMaterialMessages(relatedInformation)
+        timings["retrieval"] = time.perf_counter() - stageTime
+
+        return relatedInformation, finalAdditionList, contextTokens
+
+
+    ''' The internal ranking of the student's answer (1-5) '''
+    def ratingStage(self,question,answer,finalAdditionList,timings):
         ranking_prompt = 'You are a ranking system. You will be given a conversation between a teacher (named Athena) and a student (named ' + self.studentName + ') about ' + self.lessonSubject + ', and then you will rank how accurate their response is.' #+ ' You will pay specific attention to the wording of each question and answer, as well as the semantics of each, in order to observe the accuracy of the response.'
         qaQuery = 'The question asked by the teacher was, "' + question + '".\nThe answer given by the student was, "' + answer + '".\n Based on the student''s response to the teacher''s question, rank the student''s response quality and accuracy on an integer scale from 1-5. Do not include any other words or tokens aside from my response quality.'
 
@@ -202,12 +421,13 @@ class Tutor:
                                  'content': topicAdditionalInfoPrompt}
             ratingGptQuery.insert(1,topicInfoAddition)
 
-        finalAdditionList = self.haystackLectureMaterialConcatenationForCustomQuestionTest(question, answer)
-
         for i in range(len(finalAdditionList)):
             ratingGptQuery.insert(len(ratingGptQuery) - 1,finalAdditionList[i])  # always add the information right before the question/answer to rate
 
-        ratingGptResponse = self.gptResponse(ratingGptQuery)
+        stageTime = time.perf_counter()
+        with tracer.span("gpt.rating"):
+            ratingGptResponse = self.gptResponse(ratingGptQuery)
+        timings["rating"] = time.perf_counter() - stageTime
 
         rating = None
         if "5" in ratingGptResponse or "five" in ratingGptResponse:
@@ -222,10 +442,14 @@ class Tutor:
             rating = 1
 
         if rating is None:
+            self.forgetResponse(ratingGptQuery)
             raise Exception("GPT Response did not contain a number. The output was:" + ratingGptResponse)
 
+        return rating, ratingGptResponse
 
-        # Part 2: the response to the student
+
+    ''' The conversation that asks Athena to respond to the student's answer, given its rating '''
+    def feedbackQuery(self,question,answer,rating,finalAdditionList):
         mainPrompt = self.createMainTutorPrompt()
 
         gptQuery = [{'role': 'system', 'content': mainPrompt},
@@ -238,236 +462,112 @@ class Tutor:
         for i in range(len(finalAdditionList)):
             gptQuery.insert(len(gptQuery)-3,finalAdditionList[i]) # always add the information right before the question/answer
 
+        return gptQuery
 
-        gptResponse = self.gptResponse(gptQuery)
-
-        print("Athena: " + gptResponse)
-
-
-    ''' Concatenate information from the lecture material (if full KB is on) to the GPT request'''
-    def lectureMaterialConcatenationForCustomQuestionTest(self,question,answer):
-        ''' Keyword detection to see if any lecture material should be concatenated to the GPT request '''
-        # If lecture material concatenation is off, just return an empty list
-        if not self.lectureMaterialIncluded:
-            return []
 
-        # Define output information to append
-        relatedInformation = []
-
-        # Set of lines to add
-        addSet = set()
-
-        # Attach any relevant keyword to the list
-        i = 0
-        for encoding in self.topicEncodings:
-            for subtopic in self.lectureMaterial[encoding]:
-                i += 1
-                for keyword in subtopic["keywords"]:
-                    if keyword.lower() in question.lower():
-                        addSet.add(i)
-
-        i = 0
-        for encoding in self.topicEncodings:
-            for subtopic in self.lectureMaterial[encoding]:
-                i += 1
-                for keyword in subtopic["keywords"]:
-                    if keyword.lower() in answer.lower():
-                        addSet.add(i)
-
-        i = 0
-        for encoding in self.topicEncodings:
-            for subtopic in self.lectureMaterial[encoding]:
-                i += 1
-                if i in addSet:
-                    relatedInformation.append({"role": "system", "content": ('Please note the following lecture material that may be related to this topic: "' + subtopic["information"] + '".')})
-                    break
-
-        # Return back the updated conversation
-        return relatedInformation
-
-
-    ''' Create a file of all the generated keywords, if one does not exist. If you are changing the lecture material attached, please regenerate this file by deleting the old one.'''
-    def createKeywordsFile(self):
-        if not self.lectureMaterialIncluded:
-            return
-
-        outFilePath = "./SupervisorFiles/generatedKeywords.json"
-        if os.path.exists(outFilePath):
-            self.createLectureInformationParseFile()
-            return
-
-        generatedKeywords = dict()
+    ''' Rate a question-answer pair and write the feedback in a single GPT request. The reply must be a JSON object with the rating and the feedback; a malformed reply is retried once with a correction. '''
+    def combinedAnswerRatingResult(self,question,answer,relatedInformation,finalAdditionList,timings,startTime,maxRetries: int = 1):
+        mainPrompt = self.createMainTutorPrompt()
 
-        for encoding in self.topicEncodings:
-            generatedKeywords[encoding] = dict()
-            for subtopic in self.lectureMaterial[encoding]:
-                generatedKeywords[encoding][subtopic["name"]] = self.createKeywordsFromInformation(encoding,subtopic["name"],subtopic["information"])
+        gptQuery = [{'role': 'system', 'content': mainPrompt},
+                    {'role': 'assistant', 'content': 'I will now proceed you quiz you.\n\nCheck all that apply: ' + question},
+                    {'role': 'user', 'content': answer},
+                    {'role': 'system',
+                     'content': 'Please proceed to rate and respond to the student''s answer. First rank the student''s response quality and accuracy on an integer scale from 1-5. Then explain what about the answer was accurate or inaccurate as well as what can use improvement for a more complete knowledge, helping clear any misconceptions, using less than 75 words. Reply with ONLY a JSON object of the form {"rating": <integer from 1 to 5>, "feedback": "<your response to the student>"} and nothing else.'}]
 
-        # Create file
-        with open(outFilePath, "w") as outfile:
-            json.dump(generatedKeywords, outfile)
+        # Always add the information right before the question/answer
+        for i in range(len(finalAdditionList)):
+            gptQuery.insert(len(gptQuery)-3,finalAdditionList[i])
 
-        self.createLectureInformationParseFile()
+        stageTime = time.perf_counter()
+        (rating, feedback), gptResponse = self.parsedGptResponse(gptQuery, self.parseCombinedRatingResponse, 'a JSON object of the form {"rating": <integer from 1 to 5>, "feedback": "<your response to the student>"}',
+                                                                 "gpt.ratingAndFeedback", maxRetries)
+        timings["ratingAndFeedback"] = time.perf_counter() - stageTime
 
-    ''' Generate keywords for the specific subtopic given by the createKeywordsFile() method.'''
-    def createKeywordsFromInformation(self,encoding,name,information):
-            background = "You are a keyword generator. Your job is to generate keywords that students might use about certain topics when discussing them so that information can be retrieved."
-            prompt = 'You are creating information about the subtopic called "' + name + '", a subtopic of the topic "' + self.topicsList[encoding] + '", which is a part of the lesson subject "' + self.lessonSubject + '". Keywords should be outputted in the format [<keyword 1>, <keyword 2>,...]. Nothing else should be outputted. Please create an exhaustive keyword list for the following lecture material:\n\n' + information
+        timings["total"] = time.perf_counter() - startTime
 
-            gptQuery = [{'role':'system','content':background},
-                        {'role':'user','content':prompt}]
+        return {"question": question,
+                "answer": answer,
+                "rating": rating,
+                "ratingResponse": gptResponse,
+                "feedback": feedback,
+                "retrievedPassages": relatedInformation,
+                "timings": timings}
 
-            gptResponse = self.gptResponse(gptQuery)
 
-            bracketStart = gptResponse.find('[')
-            bracketEnd = gptResponse.find(']')
-            substring = gptResponse[bracketStart + 1:bracketEnd]
-            keywordList = substring.split(',')
-            for i in range(len(keywordList)):
-                keywordList[i] = keywordList[i].strip().lower()
+    ''' Send a request whose reply must be JSON and parse the reply with parse. A reply that cannot be parsed is shown back to GPT with the error and a
+        reminder to reply with ONLY replyFormat, up to maxRetries times. Every request is traced as spanName. Returns (parsed reply, raw reply). '''
+    def parsedGptResponse(self, gptQuery, parse, replyFormat: str, spanName: str, maxRetries: int = 1, **spanAttributes):
+        for attempt in range(maxRetries + 1):
+            with tracer.span(spanName, attempt=attempt, **spanAttributes):
+                gptResponse = self.gptResponse(gptQuery)
+            try:
+                return parse(gptResponse), gptResponse
+            except Exception as e:
+                self.forgetResponse(gptQuery)
+                if attempt == maxRetries:
+                    raise
 
-            return keywordList
+                # Show GPT its malformed reply and ask again
+                gptQuery = gptQuery + [{'role': 'assistant', 'content': gptResponse},
+                                       {'role': 'system', 'content': 'That reply could not be used (' + str(e) + '). Reply with ONLY ' + replyFormat + '.'}]
 
 
-    ''' Create the actual lecture information file that Haystack will iterate through. This includes the keywords and the lecture material. '''
-    def createLectureInformationParseFile(self):
-        keywordFile = "generatedKeywords.json"
-        outFilePath = "./HaystackSearch/processedLectureMaterial.txt"
-        outMappingPath = "./SupervisorFiles/lineToInformation.json"
-        outMapping = dict()
+    ''' Decode a reply that should be JSON, tolerating a surrounding markdown code fence '''
+    def parseJsonResponse(self,response):
+        text = response.strip()
+        if text.startswith("```"):
+            text = text.strip("`").strip()
+            if text.startswith("json"):
+                text = text[len("json"):].strip()
 
-        generatedKeywords = self.jsonToDict(keywordFile)
-        with open(outFilePath, 'w') as fh:
-            lineNumber = 1
-            for encoding in self.topicEncodings:
-                for subtopic in self.lectureMaterial[encoding]:
-                    curKeywords = generatedKeywords[encoding][subtopic["name"]]
+        try:
+            return json.loads(text)
+        except ValueError:
+            raise Exception("GPT Response was not valid JSON. The output was:" + response)
 
-                    fh.write("\tTopic Name: " + subtopic["name"] + ".")
 
-                    fh.write("\tTopic Keywords: [")
-                    for keyword in curKeywords:
-                        fh.write(keyword + ", ")
-                    fh.write("].\t")
+    ''' Strictly parse a combined rating/feedback reply. A surrounding markdown code fence is tolerated; anything else that is not a JSON object with an integer "rating" from 1-5 and a non-empty string "feedback" raises an exception. '''
+    def parseCombinedRatingResponse(self,response):
+        parsed = self.parseJsonResponse(response)
 
-                    fh.write("Topic Information: " + subtopic["information"])
+        if not isinstance(parsed, dict):
+            raise Exception("GPT Response was not a JSON object. The output was:" + response)
 
-                    outMapping[lineNumber] = subtopic["information"]
+        rating = parsed.get("rating")
+        if isinstance(rating, bool) or not isinstance(rating, int) or rating < 1 or rating > 5:
+            raise Exception("GPT Response did not contain an integer rating from 1-5. The output was:" + response)
 
-                    fh.write('\n')
-                    lineNumber+=1
+        feedback = parsed.get("feedback")
+        if not isinstance(feedback, str) or feedback.strip() == "":
+            raise Exception("GPT Response did not contain any feedback. The output was:" + response)
 
-        with open(outMappingPath, "w") as outfile:
-            json.dump(outMapping, outfile)
+        return rating, feedback.strip()
 
 
-    ''' Initializes Haystack from the Tutor Constructor. This code is adapted from https://github.com/deepset-ai/haystack/blob/main/examples/basic_qa_pipeline.py '''
-    def haystackInitialization(self):
+    ''' Concatenate information from the lecture material (if full KB is on) to the GPT request'''
+    def lectureMaterialConcatenationForCustomQuestionTest(self,question,answer):
+        ''' Keyword detection to see if any lecture material should be concatenated to the GPT request '''
+        # If lecture material concatenation is off, just return an empty list
         if not self.lectureMaterialIncluded:
-            return
-
-        print("Initializing Haystack...")
-
-        # Launch Elastic Search
-        launch_es()
-
-        document_store = ElasticsearchDocumentStore(host="localhost", username="", password="", index="document")
-        document_store.delete_documents()  # remove unrelated documents that were processed earlier
-
-        # fetch, pre-process and write documents
-        doc_dir = "./HaystackSearch/"
-        file_paths = [p for p in Path(doc_dir).glob("**/*")]
-        files_metadata = [{"name": 'processedLectureMaterial.txt'}]  # fore ach file
-
-        # Indexing Pipeline
-        indexing_pipeline = Pipeline()
-
-        # Makes sure the file is a TXT file (FileTypeClassifier node)
-        classifier = FileTypeClassifier()
-        indexing_pipeline.add_node(classifier, name="Classifier", inputs=["File"])
-
-        # Converts a file into text and performs basic cleaning (TextConverter node)
-        text_converter = TextConverter(remove_numeric_tables=True)
-        indexing_pipeline.add_node(text_converter, name="Text_converter", inputs=["Classifier.output_1"])
-
-        # - Pre-processes the text by performing splits and adding metadata to the text (Preprocessor node)
-        preprocessor = PreProcessor(
-            clean_whitespace=True,
-            clean_empty_lines=True,
-            split_length=100,
-            split_overlap=50,
-            split_respect_sentence_boundary=True,
-        )
-        indexing_pipeline.add_node(preprocessor, name="Preprocessor", inputs=["Text_converter"])
-
-        # - Writes the resulting documents into the document store
-        indexing_pipeline.add_node(document_store, name="Document_Store", inputs=["Preprocessor"])
-
-        # Then we run it with the documents and their metadata as input
-        indexing_pipeline.run(file_paths=file_paths, meta=files_metadata)
-
-        # Initialize Retriever & Reader
-        retriever = BM25Retriever(document_store=document_store)
-        reader = FARMReader(model_name_or_path="deepset/roberta-base-squad2", use_gpu=True)
-
-        # Query Pipeline
-        pipeline = Pipeline()
-        pipeline.add_node(component=retriever, name="Retriever", inputs=["Query"])
-        pipeline.add_node(component=reader, name="Reader", inputs=["Retriever"])
-
-        self.pipeline = pipeline
-
-    ''' Given a list of strings from the tutor (i..e the question and the answer), return the relevant lecture material. This is the overarching function that determines lecture material inclusion. Please note it calls all the functions that are defined below to accomplish its task. '''
-    def stringListToInformationHaystack(self,strList):
-        ''' From a list of strings, outputs all lines of relevant informaton determined by Haystack '''
-        file_path = './HaystackSearch/processedLectureMaterial.txt'
-
-        lineSet = set()
-        for query in strList:
-            try:
-                prediction = self.pipeline.run(
-                    query=query, params={"top_k": 3}
-                )
-            except:
-                prediction = self.pipeline.run(
-                    query=query, params={"top_k": 4}
-                )
-            for lineNum in self.obtainLineNumber(prediction):
-                lineSet.add(lineNum)
-
-
-        # Line number -> information
-        outInformation = []
-        linesToAdd = list(lineSet)
-        linesToAdd.sort()
-        lineToInformation = self.jsonToDict("lineToInformation.json")
-        for line in linesToAdd:
-            outInformation.append(lineToInformation[str(line)])
-
-        return outInformation
-
-
-   ''' Return the line numbers for the information that Haystack finds relevant. It takes this information in as an input. Multiple lines may be found as a result of the implementation. '''
-    def findLineNumber(self, context: str):
-        file_path = './HaystackSearch/processedLectureMaterial.txt'
-        with open(file_path, 'r') as file:
-            lines = file.readlines()
-        ls = []
-        for index, line in enumerate(lines):
-            if context in line:
-                ls.append(1 + index)
+            return []
 
-        return ls
+        # Define output information to append
+        relatedInformation = []
 
-    ''' Multiple outputs are likely to be given by Haystack. As a result, we choose to use every output to concatenate the relevant information and feed it all back for GPT concatenation.'''
-    def obtainLineNumber(self,prediction):
-        answers = prediction["answers"]
-        outLineNumberList = []
+        # Lines to add (subtopic ID -> number of keyword matches in the question and answer)
+        addSet = self.keywordMatcher.match(question, answer)
 
-        for answer in answers:
-            outLineNumberList.extend(self.findLineNumber(answer.context))
+        i = 0
+        for encoding in self.topicEncodings:
+            for subtopic in self.lectureMaterial[encoding]:
+                i += 1
+                if i in addSet:
+                    relatedInformation.append({"role": "system", "content": lectureMaterialTemplate.format(subtopic["information"])})
+                    break
 
-        return outLineNumberList
+        # Return back the updated conversation
+        return relatedInformation
 
 
     ''' Given the question and answer, yields all relevant information in a format ready for GPT concatenation '''
@@ -477,28 +577,29 @@ class Tutor:
         if not self.lectureMaterialIncluded:
             return []
 
-        # Define output information to append
-
-        outAdditions = []
-        try:
-            relatedInformation = self.stringListToInformationHaystack([question,answer])
-        except: # If there's a pop error, concatenate the information together so that there's a greater chance of something being found
-            relatedInformation = self.stringListToInformationHaystack([question + answer])
-
-        for i in range(len(relatedInformation)):
-            outAdditions.append({"role": "system", "content": ('Please note the following lecture material that may be related to this topic: "' + relatedInformation[i] + '".')})
-
-        # Return back the updated conversation
-        return outAdditions
-
-
-
+        return self.lectureMaterialMessages(self.relatedLectureMaterial(question, answer))
 
 
+    ''' Given the question and answer, return the relevant lecture material found by the knowledge base (empty if the full KB is off) '''
+    def relatedLectureMaterial(self,question,answer):
+        if not self.lectureMaterialIncluded:
+            return []
 
+        return self.knowledgeBase.relatedLectureMaterial(question, answer)
 
 
+    ''' From a list of strings, outputs all lines of relevant information determined by the knowledge base '''
+    def stringListToInformationHaystack(self,strList):
+        return self.knowledgeBase.stringListToInformationHaystack(strList)
 
 
+    ''' Turn lecture material into system messages ready for GPT concatenation '''
+    def lectureMaterialMessages(self,relatedInformation):
+        # Define output information to append
+        outAdditions = []
 
+        for i in range(len(relatedInformation)):
+            outAdditions.append({"role": "system", "content": lectureMaterialTemplate.format(relatedInformation[i])})
 
+        # Return back the updated conversation
+        return outAdditions
@@ -0,0 +1,422 @@
+import argparse
+import asyncio
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+
+from ResponseCache import ResponseCache
+from ChatClient import OpenAIClient
+from KnowledgeBase import KnowledgeBase
+from CourseRegistry import CourseRegistry
+from Tutor import Tutor
+from QuestionBank import QuestionBank
+from Tracing import tracer, PrometheusExporter
+
+
+''' A resident HTTP service for the tutors, so that the knowledge base is loaded once instead of on every run of runme.py.
+    Example: python TutorService.py --port 8000 --backend inmemory --mode retriever
+
+    POST /answerRating     {"question", "answer", "studentName", "depth" ("noKB", "partialKB" or "fullKB"), "course"}  -> the rating result
+    POST /questionCreator  {"studentName", "questionCount", "course"}                                             -> the generated questions
+    POST /retrieval        {"question", "answer", "course"}                                                       -> the related lecture material
+    GET  /health           -> status, queue and worker counts
+    GET  /metrics          -> Prometheus text: request counters and, with tracing, the pipeline stages
+
+    "course" is only used (and required) when the service serves a CourseRegistry. '''
+
+
+# Knowledge base depth -> (topicsInformationIncluded, lectureMaterialIncluded)
+tutorDepths = {"noKB": (False, False), "partialKB": (True, False), "fullKB": (True, True)}
+
+maxBodyBytes = 1024 * 1024
+
+
+class ServiceError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class TutorService:
+    ''' Serves answerRating, questionCreator and retrieval over HTTP with asyncio. Blocking retrieval, reader and GPT work runs on a bounded thread
+        pool of maxWorkers; up to maxQueue further requests wait for a worker, and requests beyond that are refused at once with 503 and a
+        Retry-After header. Tutors are cheap (they share the knowledge base) and are cached per course, depth and student. '''
+    def __init__(self, knowledgeBase: KnowledgeBase = None, registry: CourseRegistry = None, maxWorkers: int = 8, maxQueue: int = 64, maxTutors: int = 1024, **tutorSettings):
+        if (knowledgeBase is None) == (registry is None):
+            raise Exception("Give either a knowledge base or a course registry")
+
+        self.knowledgeBase = knowledgeBase
+        self.registry = registry
+        self.maxWorkers = maxWorkers
+        self.maxQueue = maxQueue
+        self.maxTutors = maxTutors
+
+        # Keyword arguments passed to every Tutor (API_KEY, model, responseCache, openAIClient, combinedRating, packContext...)
+        self.tutorSettings = tutorSettings
+
+        self.executor = ThreadPoolExecutor(max_workers=maxWorkers, thread_name_prefix="tutorWorker")
+
+        # The subtopics of /questionCreator requests are generated here, so all requests together send at most maxWorkers of them to GPT at once
+        self.questionExecutor = ThreadPoolExecutor(max_workers=maxWorkers, thread_name_prefix="questionWorker")
+
+        # Question bank path -> (question bank, lock held while questions are generated into it), shared by the requests of a course
+        self.questionBanks = dict()
+        self.questionBanksLock = threading.Lock()
+        self.workerSlots = None     # created on the event loop in start()
+        self.tutors = OrderedDict()
+        self.tutorsLock = threading.Lock()
+
+        # Cached tutors hold their course's knowledge base, so they are dropped when the registry evicts the course
+        if registry is not None:
+            registry.addEvictionListener(self.dropCourseTutors)
+
+        self.queued = 0
+        self.running = 0
+        self.requestCounts = dict()     # (endpoint, status) -> count
+        self.requestSeconds = dict()    # endpoint -> total seconds
+        self.startedAt = time.time()
+
+        self.metrics = PrometheusExporter()
+        self.server = None
+
+        self.routes = {("POST", "/answerRating"): self.answerRating,
+                       ("POST", "/questionCreator"): self.questionCreator,
+                       ("POST", "/retrieval"): self.retrieval,
+                       ("GET", "/health"): self.health,
+                       ("GET", "/metrics"): self.metricsText}
+
+
+    ''' Start listening. With tracePipeline, the pipeline stages are traced into the /metrics output too. '''
+    async def start(self, host: str = "127.0.0.1", port: int = 8000, tracePipeline: bool = True):
+        self.workerSlots = asyncio.Semaphore(self.maxWorkers)
+        if tracePipeline and not tracer.enabled:
+            tracer.enable(self.metrics)
+
+        self.server = await asyncio.start_server(self.handleConnection, host, port)
+        return self
+
+    @property
+    def port(self):
+        return self.server.sockets[0].getsockname()[1]
+
+    async def serveForever(self):
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        self.executor.shutdown(wait=False)
+        self.questionExecutor.shutdown(wait=False)
+        with self.questionBanksLock:
+            for questionBank, _ in self.questionBanks.values():
+                questionBank.close()
+
+
+    ''' Read HTTP/1.1 requests from a connection (kept alive unless the client asks otherwise) and answer each '''
+    async def handleConnection(self, reader, writer):
+        try:
+            while True:
+                requestLine = await reader.readline()
+                if not requestLine:
+                    break
+
+                headers = dict()
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                try:
+                    method, target, version = requestLine.decode("latin-1").split()
+                except ValueError:
+                    await self.respond(writer, HTTPStatus.BAD_REQUEST, {"error": "Malformed request line"}, keepAlive=False)
+                    break
+
+                # Only Content-Length bodies are supported; a chunked body could not be framed, so the connection is closed after the error
+                if headers.get("transfer-encoding", "").lower() not in ("", "identity"):
+                    await self.respond(writer, HTTPStatus.NOT_IMPLEMENTED, {"error": "Transfer-Encoding is not supported, send a Content-Length"}, keepAlive=False)
+                    break
+
+                try:
+                    length = int(headers.get("content-length", 0) or 0)
+                except ValueError:
+                    length = -1
+                if length < 0:
+                    await self.respond(writer, HTTPStatus.BAD_REQUEST, {"error": "Bad Content-Length"}, keepAlive=False)
+                    break
+                if length > maxBodyBytes:
+                    await self.respond(writer, HTTPStatus.REQUEST_ENTITY_TOO_LARGE, {"error": "Request body too large"}, keepAlive=False)
+                    break
+                # Clients sending "Expect: 100-continue" wait for this interim response before the body (sent once the body is known to be acceptable)
+                if length > 0 and headers.get("expect", "").lower() == "100-continue":
+                    writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+                    await writer.drain()
+                body = await reader.readexactly(length) if length > 0 else b""
+
+                keepAlive = headers.get("connection", "").lower() != "close" and version == "HTTP/1.1"
+                status, payload, extraHeaders = await self.dispatch(method, target.split("?")[0], body)
+                await self.respond(writer, status, payload, keepAlive, extraHeaders)
+                if not keepAlive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+    async def dispatch(self, method: str, path: str, body: bytes):
+        startTime = time.perf_counter()
+        extraHeaders = dict()
+
+        handler = self.routes.get((method, path))
+        try:
+            if handler is None:
+                knownPath = any(routePath == path for _, routePath in self.routes)
+                raise ServiceError(HTTPStatus.METHOD_NOT_ALLOWED if knownPath else HTTPStatus.NOT_FOUND, "No route for " + method + " " + path)
+
+            request = dict()
+            if method == "POST":
+                try:
+                    request = json.loads(body or b"{}")
+                except ValueError:
+                    raise ServiceError(HTTPStatus.BAD_REQUEST, "The request body is not valid JSON")
+                if not isinstance(request, dict):
+                    raise ServiceError(HTTPStatus.BAD_REQUEST, "The request body must be a JSON object")
+
+            status, payload = HTTPStatus.OK, await handler(request)
+        except ServiceError as e:
+            status, payload = e.status, {"error": str(e)}
+            if e.status == HTTPStatus.SERVICE_UNAVAILABLE:
+                extraHeaders["Retry-After"] = "1"
+        except Exception as e:
+            status, payload = HTTPStatus.INTERNAL_SERVER_ERROR, {"error": str(e)}
+
+        key = (path if handler is not None else "unknown", int(status))
+        self.requestCounts[key] = self.requestCounts.get(key, 0) + 1
+        self.requestSeconds[key[0]] = self.requestSeconds.get(key[0], 0.0) + time.perf_counter() - startTime
+
+        return status, payload, extraHeaders
+
+
+    async def respond(self, writer, status, payload, keepAlive: bool, extraHeaders: dict = None):
+        if isinstance(payload, str):
+            data, contentType = payload.encode("utf-8"), "text/plain; version=0.0.4"
+        else:
+            data, contentType = json.dumps(payload).encode("utf-8"), "application/json"
+
+        status = HTTPStatus(status)
+        head = ["HTTP/1.1 " + str(status.value) + " " + status.phrase,
+                "Content-Type: " + contentType,
+                "Content-Length: " + str(len(data)),
+                "Connection: " + ("keep-alive" if keepAlive else "close")]
+        head += [name + ": " + value for name, value in (extraHeaders or dict()).items()]
+
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + data)
+        await writer.drain()
+
+
+    ''' Run blocking work on the worker pool once a worker is free, refusing the request if the queue is full '''
+    async def runBlocking(self, function, *args):
+        if self.queued >= self.maxQueue and self.workerSlots.locked():
+            raise ServiceError(HTTPStatus.SERVICE_UNAVAILABLE, "The service is busy, please retry")
+
+        self.queued += 1
+        try:
+            await self.workerSlots.acquire()
+        finally:
+            self.queued -= 1
+
+        self.running += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+        finally:
+            self.running -= 1
+            self.workerSlots.release()
+
+
+    ''' The (cached) tutor for a course, knowledge base depth and student '''
+    def tutorFor(self, course, depth: str, studentName: str):
+        if depth not in tutorDepths:
+            raise ServiceError(HTTPStatus.BAD_REQUEST, 'Bad depth "' + str(depth) + '"; use one of ' + ", ".join(tutorDepths))
+        if not isinstance(studentName, str) or studentName.strip() == "":
+            raise ServiceError(HTTPStatus.BAD_REQUEST, "No student name is present")
+
+        knowledgeBase = self.knowledgeBaseFor(course)
+
+        key = (course, depth, studentName)
+        with self.tutorsLock:
+            # A tutor built before its course was evicted and reloaded would keep a second copy of the course in memory
+            if key in self.tutors and self.tutors[key].knowledgeBase is knowledgeBase:
+                self.tutors.move_to_end(key)
+                return self.tutors[key]
+
+        topicsInformationIncluded, lectureMaterialIncluded = tutorDepths[depth]
+        tutor = Tutor(studentName=studentName, knowledgeBase=knowledgeBase, topicsInformationIncluded=topicsInformationIncluded,
+                      lectureMaterialIncluded=lectureMaterialIncluded, **self.tutorSettings)
+
+        with self.tutorsLock:
+            self.tutors[key] = tutor
+            while len(self.tutors) > self.maxTutors:
+                self.tutors.popitem(last=False)
+
+        return tutor
+
+
+    ''' Forget the cached tutors of an evicted course '''
+    def dropCourseTutors(self, course):
+        with self.tutorsLock:
+            for key in [key for key in self.tutors if key[0] == course]:
+                del self.tutors[key]
+
+
+    def knowledgeBaseFor(self, course):
+        if self.registry is None:
+            return self.knowledgeBase
+
+        if course is None:
+            raise ServiceError(HTTPStatus.BAD_REQUEST, "No course is present")
+        if course not in self.registry.courses:
+            raise ServiceError(HTTPStatus.NOT_FOUND, 'Unknown course "' + str(course) + '"')
+
+        return self.registry.get(course)
+
+
+    def requiredText(self, request: dict, name: str):
+        value = request.get(name)
+        if not isinstance(value, str) or value.strip() == "":
+            raise ServiceError(HTTPStatus.BAD_REQUEST, 'No "' + name + '" is present')
+        return value
+
+
+    async def answerRating(self, request: dict):
+        question, answer = self.requiredText(request, "question"), self.requiredText(request, "answer")
+
+        def rate():
+            tutor = self.tutorFor(request.get("course"), request.get("depth", "fullKB"), request.get("studentName"))
+            with tracer.span("service.answerRating"):
+                return tutor.answerRatingResult(question, answer)
+
+        return await self.runBlocking(rate)
+
+
+    ''' The question bank of a knowledge base's course with its lock, opened once for all requests '''
+    def questionBankFor(self, knowledgeBase: KnowledgeBase):
+        path = QuestionBank.defaultPath(knowledgeBase.courseDirectory)
+        with self.questionBanksLock:
+            if path not in self.questionBanks:
+                self.questionBanks[path] = (QuestionBank(path), threading.Lock())
+            return self.questionBanks[path]
+
+
+    async def questionCreator(self, request: dict):
+        # The count is part of the question bank keys, so "2" and 2 must not both be accepted
+        questionCount = request.get("questionCount", 3)
+        if isinstance(questionCount, bool) or not isinstance(questionCount, int) or questionCount < 1:
+            raise ServiceError(HTTPStatus.BAD_REQUEST, '"questionCount" must be a positive integer')
+
+        def create():
+            tutor = self.tutorFor(request.get("course"), "fullKB", request.get("studentName", "Student"))
+            questionBank, questionBankLock = self.questionBankFor(tutor.knowledgeBase)
+
+            # Concurrent requests for a course wait for each other, then find the questions already in the bank
+            with questionBankLock, tracer.span("service.questionCreator"):
+                return {"questions": tutor.questionCreator(questionCount=questionCount, questionBank=questionBank, executor=self.questionExecutor, verbose=False)}
+
+        return await self.runBlocking(create)
+
+
+    async def retrieval(self, request: dict):
+        question, answer = self.requiredText(request, "question"), self.requiredText(request, "answer")
+
+        def retrieve():
+            knowledgeBase = self.knowledgeBaseFor(request.get("course"))
+            if not knowledgeBase.lectureMaterialIncluded:
+                raise ServiceError(HTTPStatus.CONFLICT, "The knowledge base does not include the lecture material.")
+            with tracer.span("service.retrieval"):
+                return {"candidates": knowledgeBase.relatedLectureMaterialCandidates(question, answer)}
+
+        return await self.runBlocking(retrieve)
+
+
+    async def health(self, request: dict):
+        return {"status": "ok",
+                "uptime": time.time() - self.startedAt,
+                "queued": self.queued,
+                "running": self.running,
+                "maxWorkers": self.maxWorkers,
+                "maxQueue": self.maxQueue,
+                "courses": self.registry.stats() if self.registry is not None else None}
+
+
+    async def metricsText(self, request: dict):
+        lines = ["# HELP tutor_service_requests_total Requests handled, by endpoint and status.",
+                 "# TYPE tutor_service_requests_total counter"]
+        for (endpoint, status), count in sorted(self.requestCounts.items()):
+            lines.append('tutor_service_requests_total{endpoint="' + endpoint + '",status="' + str(status) + '"} ' + str(count))
+
+        lines += ["# HELP tutor_service_request_seconds_total Time spent handling requests, by endpoint.",
+                  "# TYPE tutor_service_request_seconds_total counter"]
+        for endpoint, seconds in sorted(self.requestSeconds.items()):
+            lines.append('tutor_service_request_seconds_total{endpoint="' + endpoint + '"} ' + repr(seconds))
+
+        lines += ["# TYPE tutor_service_queued gauge", "tutor_service_queued " + str(self.queued),
+                  "# TYPE tutor_service_running gauge", "tutor_service_running " + str(self.running)]
+
+        return "\n".join(lines) + "\n" + self.metrics.snapshot()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the tutors over HTTP")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--lesson-subject", default="History of AI")
+    parser.add_argument("--courses", default=None, help="Serve every course found in this directory (see CourseRegistry) instead of ./SupervisorFiles")
+    parser.add_argument("--memory-limit", type=int, default=1024, help="Memory limit of the loaded courses, in MB (with --courses)")
+    parser.add_argument("--model", type=int, default=4, choices=[3, 4])
+    parser.add_argument("--backend", default="elasticsearch", choices=["elasticsearch", "inmemory"])
+    parser.add_argument("--mode", default="reader", choices=["reader", "retriever"])
+    parser.add_argument("--workers", type=int, default=8, help="Requests processed at once")
+    parser.add_argument("--queue", type=int, default=64, help="Requests waiting for a worker before new ones are refused")
+    parser.add_argument("--combined-rating", action="store_true")
+    parser.add_argument("--pack-context", action="store_true")
+    parser.add_argument("--api-base", default=None, help="Send GPT requests to this endpoint instead of OpenAI")
+    args = parser.parse_args()
+
+    API_KEY = os.environ.get("OPENAI_API_KEY")
+    if os.path.exists("API_KEY.txt"):
+        with open("API_KEY.txt", "r") as file:
+            API_KEY = file.read()
+
+    responseCache = ResponseCache()
+    openAIClient = OpenAIClient(apiBase=args.api_base)
+    settings = {"API_KEY": API_KEY, "model": args.model, "responseCache": responseCache, "openAIClient": openAIClient}
+    knowledgeBaseSettings = dict(settings, topicsInformationIncluded=True, lectureMaterialIncluded=True, retrievalBackend=args.backend, retrievalMode=args.mode)
+
+    # Load the knowledge base once, before accepting requests
+    knowledgeBase, registry = None, None
+    if args.courses is not None:
+        registry = CourseRegistry(args.courses, memoryLimitBytes=args.memory_limit * 1024 * 1024, **knowledgeBaseSettings)
+    else:
+        knowledgeBase = KnowledgeBase(lessonSubject=args.lesson_subject, **knowledgeBaseSettings)
+
+    service = TutorService(knowledgeBase=knowledgeBase, registry=registry, maxWorkers=args.workers, maxQueue=args.queue,
+                           combinedRating=args.combined_rating, packContext=args.pack_context, **settings)
+
+    async def serve():
+        await service.start(args.host, args.port)
+        print("Serving on http://" + args.host + ":" + str(service.port))
+        await service.serveForever()
+
+    asyncio.run(serve())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,249 @@
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+from functools import wraps
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+from FakeOpenAIServer import FakeOpenAIServer
+from ChatClient import OpenAIClient
+from KnowledgeBase import KnowledgeBase
+from Tutor import Tutor
+from BatchEvaluator import evaluateTutors
+from benchmarkRetrieval import percentile
+from Tracing import tracer, JsonLinesSpanExporter
+from InMemoryBM25 import sentencePattern
+
+
+''' End-to-end benchmark of the tutor pipeline that runs offline: GPT requests go to a local FakeOpenAIServer with configurable latency and retrieval
+    uses the in-memory BM25 backend, so no API key, Docker or Elasticsearch is needed. The lecture material is scaled synthetically from
+    SupervisorFiles/lectureMaterial.json (every subtopic is copied with its sentences rotated) to show how each stage grows with the course size.
+    For every scale it reports per-stage latency percentiles, grading throughput and peak memory as JSON. Every scale runs in its own process, so
+    its peak memory is not carried over from the previous scales.
+    Example: python benchmarkPipeline.py --scales 1 4 16 --latency 0.2 --output pipelineBenchmark.json '''
+
+
+''' The lecture material with every subtopic repeated scale times. Copies get a numbered name and their sentences rotated, so their content (and keywords) differ. '''
+def scaledLectureMaterial(lectureMaterial: dict, scale: int):
+    scaled = dict()
+    for encoding, subtopics in lectureMaterial.items():
+        scaled[encoding] = []
+        for copy in range(scale):
+            for subtopic in subtopics:
+                if copy == 0:
+                    scaled[encoding].append(subtopic)
+                    continue
+
+                sentences = sentencePattern.split(subtopic["information"].strip())
+                shift = copy % len(sentences)
+                scaled[encoding].append({"name": subtopic["name"] + " (" + str(copy + 1) + ")",
+                                         "information": " ".join(sentences[shift:] + sentences[:shift])})
+
+    return scaled
+
+
+''' Create a course directory holding the scaled supervisor files '''
+def createCorpus(sourceDirectory: str, scale: int):
+    directory = tempfile.mkdtemp(prefix="tutorBenchmark")
+    os.makedirs(os.path.join(directory, "SupervisorFiles"))
+    os.makedirs(os.path.join(directory, "HaystackSearch"))
+
+    for fn in ["topicsList.json", "topicsInformationList.json"]:
+        shutil.copy(os.path.join(sourceDirectory, "SupervisorFiles", fn), os.path.join(directory, "SupervisorFiles", fn))
+
+    with open(os.path.join(sourceDirectory, "SupervisorFiles", "lectureMaterial.json")) as fh:
+        lectureMaterial = json.load(fh)
+
+    with open(os.path.join(directory, "SupervisorFiles", "lectureMaterial.json"), "w") as outfile:
+        json.dump(scaledLectureMaterial(lectureMaterial, scale), outfile)
+
+    return directory
+
+
+''' A select-all-that-apply question per subtopic (up to count), built from its sentences, with a partially correct answer '''
+def syntheticQuestionBank(knowledgeBase, count: int):
+    questionBank = []
+    lines = sorted(knowledgeBase.lineToSubtopic.items())
+    step = max(1, len(lines) // count)
+
+    for lineNumber, (encoding, name) in lines[::step][:count]:
+        sentences = sentencePattern.split(knowledgeBase.lineToInformation[lineNumber].strip())
+        options = " ".join(letter + ") " + sentence for letter, sentence in zip("abcd", sentences[1:5]))
+        questionBank.append({"q": "Which of the following are true about " + name + "? " + options,
+                             "a": "A, C: " + sentences[0]})
+
+    return questionBank
+
+
+''' Record the latency of every call to the given methods (wrapped on their class while the block runs) into samples[method name] '''
+@contextmanager
+def timedMethods(samples: dict, cls, names):
+    originals = {name: getattr(cls, name) for name in names}
+
+    def timed(name, method):
+        @wraps(method)
+        def wrapper(*args, **kwargs):
+            startTime = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                samples.setdefault(name, []).append(time.perf_counter() - startTime)
+        return wrapper
+
+    for name, method in originals.items():
+        setattr(cls, name, timed(name, method))
+    try:
+        yield samples
+    finally:
+        for name, method in originals.items():
+            setattr(cls, name, method)
+
+
+def summarize(values):
+    if len(values) == 0:
+        return None
+
+    return {"count": len(values),
+            "mean": sum(values) / len(values),
+            "p50": percentile(values, 0.5),
+            "p90": percentile(values, 0.9),
+            "p99": percentile(values, 0.99),
+            "max": max(values)}
+
+
+''' Maximum resident set size of this process so far, in bytes '''
+def maxResidentBytes():
+    if resource is None:
+        return None
+
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if os.uname().sysname == "Darwin" else maxrss * 1024
+
+
+''' Run benchmarkScale in a fresh process, so that the peak memory it reports belongs to this scale alone (ru_maxrss only ever grows within a process) '''
+def benchmarkScaleInProcess(args, scale: int, sourceDirectory: str):
+    with multiprocessing.get_context("spawn").Pool(1, initializer=startScaleProcess, initargs=(args,)) as pool:
+        return pool.apply(benchmarkScale, (args, scale, sourceDirectory))
+
+
+''' Pool initializer: the spans of the scale's process are written to the --trace file '''
+def startScaleProcess(args):
+    if args.trace is not None:
+        tracer.enable(JsonLinesSpanExporter(os.path.abspath(args.trace)))
+
+
+''' Run every stage on one scaled corpus '''
+def benchmarkScale(args, scale: int, sourceDirectory: str):
+    directory = createCorpus(sourceDirectory, scale)
+    samples = dict()
+
+    if args.trace_memory:
+        tracemalloc.start()
+
+    server = FakeOpenAIServer(latency=args.latency).start()
+    client = OpenAIClient(rateLimits=dict(), apiBase=server.apiBase)
+    settings = {"API_KEY": "benchmark", "lessonSubject": args.lesson_subject, "model": 4, "topicsInformationIncluded": True, "lectureMaterialIncluded": True,
+                "retrievalBackend": "inmemory", "retrievalMode": args.mode, "openAIClient": client, "courseDirectory": directory}
+
+    try:
+        with timedMethods(samples, KnowledgeBase, ["createKeywordsFile", "createLectureInformationParseFile", "haystackInitialization"]):
+            # Cold: every subtopic's keywords are generated and the index is built
+            startTime = time.perf_counter()
+            knowledgeBase = KnowledgeBase(keywordWorkers=args.workers, **settings)
+            samples["knowledgeBaseCold"] = [time.perf_counter() - startTime]
+
+            # Warm: keywords and index are reused from disk
+            for i in range(args.repeat):
+                startTime = time.perf_counter()
+                KnowledgeBase(keywordWorkers=args.workers, **settings)
+                samples.setdefault("knowledgeBaseWarm", []).append(time.perf_counter() - startTime)
+
+        tutorSettings = {"API_KEY": "benchmark", "studentName": "Student", "lessonSubject": args.lesson_subject, "model": 4, "openAIClient": client}
+        depths = {"noKB": (False, False), "partialKB": (True, False), "fullKB": (True, True)}
+        tutors = dict()
+        for i in range(args.repeat):
+            for name, (topicsInformationIncluded, lectureMaterialIncluded) in depths.items():
+                startTime = time.perf_counter()
+                tutors[name] = Tutor(topicsInformationIncluded=topicsInformationIncluded, lectureMaterialIncluded=lectureMaterialIncluded, knowledgeBase=knowledgeBase, **tutorSettings)
+                samples.setdefault("tutorConstruction", []).append(time.perf_counter() - startTime)
+
+        questionBank = syntheticQuestionBank(knowledgeBase, args.questions)
+
+        for item in questionBank:
+            startTime = time.perf_counter()
+            knowledgeBase.relatedLectureMaterial(item["q"], item["a"])
+            samples.setdefault("retrieval", []).append(time.perf_counter() - startTime)
+
+        # Sequential grading gives the per-stage latencies of answerRating
+        for item in questionBank:
+            result = tutors["fullKB"].answerRatingResult(item["q"], item["a"])
+            for stage, seconds in result["timings"].items():
+                samples.setdefault("answerRating." + stage, []).append(seconds)
+
+        # Concurrent grading of the whole question bank by the three tutors gives the throughput
+        startTime = time.perf_counter()
+        results = evaluateTutors(tutors, questionBank, maxWorkers=args.workers)
+        elapsed = time.perf_counter() - startTime
+        graded = sum(1 for tutorResults in results.values() for result in tutorResults if "error" not in result)
+        errors = sum(1 for tutorResults in results.values() for result in tutorResults if "error" in result)
+
+        report = {"scale": scale,
+                  "subtopics": len(knowledgeBase.processedLines),
+                  "lectureMaterialCharacters": sum(len(information) for information in knowledgeBase.lineToInformation.values()),
+                  "questions": len(questionBank),
+                  "stages": {stage: summarize(values) for stage, values in sorted(samples.items())},
+                  "throughput": {"graded": graded, "errors": errors, "seconds": elapsed, "answersPerSecond": graded / elapsed if elapsed > 0 else None},
+                  "fakeOpenAI": server.stats(),
+                  "memory": {"maxResidentBytes": maxResidentBytes()}}
+
+        if args.trace_memory:
+            report["memory"]["tracedPeakBytes"] = tracemalloc.get_traced_memory()[1]
+    finally:
+        server.stop()
+        if args.trace_memory:
+            tracemalloc.stop()
+        shutil.rmtree(directory, ignore_errors=True)
+
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the tutor pipeline offline against a fake OpenAI endpoint and the in-memory store")
+    parser.add_argument("--lesson-subject", default="History of AI")
+    parser.add_argument("--scales", nargs="+", type=int, default=[1, 4, 16], help="Copies of the lecture material in the synthetic corpus")
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds the fake OpenAI endpoint waits before every reply")
+    parser.add_argument("--mode", default="retriever", choices=["reader", "retriever"])
+    parser.add_argument("--questions", type=int, default=20, help="Questions graded per scale")
+    parser.add_argument("--workers", type=int, default=8, help="Concurrent keyword generation and grading jobs")
+    parser.add_argument("--repeat", type=int, default=3, help="Times the warm knowledge base and tutor construction are timed")
+    parser.add_argument("--trace-memory", action="store_true", help="Also report the peak of Python allocations (slows every stage down)")
+    parser.add_argument("--output", default=None, help="Write the results as JSON to this file (printed otherwise)")
+    parser.add_argument("--trace", default=None, help="Also write every pipeline span to this JSONL file")
+    args = parser.parse_args()
+
+    sourceDirectory = os.path.dirname(os.path.abspath(__file__))
+    results = {"config": {"latency": args.latency, "mode": args.mode, "questions": args.questions, "workers": args.workers, "repeat": args.repeat},
+               "scales": [benchmarkScaleInProcess(args, scale, sourceDirectory) for scale in args.scales]}
+
+    if args.output is not None:
+        with open(args.output, "w") as outfile:
+            json.dump(results, outfile, indent=2)
+
+        for report in results["scales"]:
+            print("scale " + str(report["scale"]) + " (" + str(report["subtopics"]) + " subtopics): cold KB " + str(round(report["stages"]["knowledgeBaseCold"]["p50"], 3)) + "s, retrieval p50 " +
+                  str(round(report["stages"]["retrieval"]["p50"], 4)) + "s, " + str(round(report["throughput"]["answersPerSecond"], 2)) + " answers/s")
+    else:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
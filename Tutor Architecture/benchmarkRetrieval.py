@@ -0,0 +1,109 @@
+import argparse
+import json
+import os
+import time
+
+from KnowledgeBase import KnowledgeBase
+
+
+''' Compare the retrieval-only mode against the reader mode: recall of the expected subtopic line and per-query latency.
+    By default every subtopic contributes one query built from its first generated keywords; --queries may instead point to a JSONL file of
+    {"query": ..., "lineNumber": ...} records. Example: python benchmarkRetrieval.py --backend inmemory --output retrievalBenchmark.json '''
+
+
+''' One query per subtopic, built from its generated keywords, expecting that subtopic's line '''
+def syntheticQueries(knowledgeBase, keywordsPerQuery: int = 3):
+    queries = []
+    for lineNumber, (encoding, name) in sorted(knowledgeBase.lineToSubtopic.items()):
+        keywords = knowledgeBase.generatedKeywords[encoding][name][:keywordsPerQuery]
+        queries.append({"query": "What can you tell me about " + ", ".join(keywords) + "?", "lineNumber": lineNumber})
+
+    return queries
+
+
+def percentile(values, fraction: float):
+    ordered = sorted(values)
+    if len(ordered) == 0:
+        return None
+
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+''' Run every query through the knowledge base, timing retrieval plus the mapping to line numbers '''
+def runQueries(knowledgeBase, queries, topK: int = 3, repeat: int = 1):
+    latencies = []
+    predictedLines = []
+    hits = 0
+
+    for item in queries:
+        for i in range(repeat):
+            startTime = time.perf_counter()
+            lines = knowledgeBase.obtainLineNumber(knowledgeBase.retrievalPrediction(item["query"], topK))
+            latencies.append(time.perf_counter() - startTime)
+
+        predictedLines.append(sorted(set(lines)))
+        hits += item["lineNumber"] in lines
+
+    return {"recall": hits / len(queries) if queries else None,
+            "meanLines": sum(len(lines) for lines in predictedLines) / len(queries) if queries else None,
+            "latencyP50": percentile(latencies, 0.5),
+            "latencyP95": percentile(latencies, 0.95),
+            "latencyMax": max(latencies) if latencies else None,
+            "predictedLines": predictedLines}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark retrieval-only mode against the reader mode")
+    parser.add_argument("--lesson-subject", default="History of AI")
+    parser.add_argument("--backend", default="inmemory", choices=["inmemory", "elasticsearch"])
+    parser.add_argument("--modes", nargs="+", default=["reader", "retriever"], choices=["reader", "retriever"])
+    parser.add_argument("--queries", default=None, help="JSONL file of {\"query\": ..., \"lineNumber\": ...} records")
+    parser.add_argument("--top-k", type=int, default=3)
+    parser.add_argument("--repeat", type=int, default=3, help="Times each query is timed")
+    parser.add_argument("--min-score", type=float, default=None, help="minRetrievalScore used in retriever mode")
+    parser.add_argument("--output", default=None, help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    # Keywords are normally generated already, in which case the key is never used
+    API_KEY = "unused"
+    if os.path.exists("API_KEY.txt"):
+        with open("API_KEY.txt", "r") as file:
+            API_KEY = file.read()
+
+    results = {"backend": args.backend, "topK": args.top_k, "modes": dict()}
+    queries = None
+
+    for mode in args.modes:
+        startTime = time.perf_counter()
+        knowledgeBase = KnowledgeBase(API_KEY=API_KEY, lessonSubject=args.lesson_subject, model=4, topicsInformationIncluded=True, lectureMaterialIncluded=True,
+                                      retrievalBackend=args.backend, retrievalMode=mode, minRetrievalScore=args.min_score)
+        setupTime = time.perf_counter() - startTime
+
+        if queries is None:
+            if args.queries is None:
+                queries = syntheticQueries(knowledgeBase)
+            else:
+                with open(args.queries) as fh:
+                    queries = [json.loads(line) for line in fh if line.strip()]
+
+        results["modes"][mode] = runQueries(knowledgeBase, queries, topK=args.top_k, repeat=args.repeat)
+        results["modes"][mode]["setupTime"] = setupTime
+
+    # How many of the reader's lines the retrieval-only mode also finds
+    if "reader" in results["modes"] and "retriever" in results["modes"]:
+        found, total = 0, 0
+        for readerLines, retrieverLines in zip(results["modes"]["reader"]["predictedLines"], results["modes"]["retriever"]["predictedLines"]):
+            found += len(set(readerLines) & set(retrieverLines))
+            total += len(readerLines)
+        results["retrieverRecallOfReaderLines"] = found / total if total else None
+
+    for mode, result in results["modes"].items():
+        print(mode + ": recall " + str(result["recall"]) + ", p50 " + str(result["latencyP50"]) + "s, p95 " + str(result["latencyP95"]) + "s, setup " + str(result["setupTime"]) + "s")
+
+    if args.output is not None:
+        with open(args.output, "w") as outfile:
+            json.dump(results, outfile, indent=2)
+
+
+if __name__ == "__main__":
+    main()
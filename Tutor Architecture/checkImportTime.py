@@ -0,0 +1,76 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+
+''' Startup budget check for the lightweight tutors. In a fresh interpreter it imports Tutor and builds a no-KB and a partial-KB tutor, then checks
+    that this stayed within the time and memory budgets and that no heavy dependency (haystack, torch, transformers) was imported. Exits with status 1
+    if a budget is exceeded. Example: python checkImportTime.py --budget 1.0 '''
+
+
+heavyModules = ["haystack", "torch", "transformers", "elasticsearch"]
+
+# Run in the child interpreter; prints its measurements as JSON
+startupScript = """
+import json, sys, time
+startTime = time.perf_counter()
+import Tutor
+importTime = time.perf_counter() - startTime
+
+tutorNoKB = Tutor.Tutor(API_KEY="unused", studentName="Student", lessonSubject="History of AI", model=4, topicsInformationIncluded=False, lectureMaterialIncluded=False)
+tutorPartialKB = Tutor.Tutor(API_KEY="unused", studentName="Student", lessonSubject="History of AI", model=4, topicsInformationIncluded=True, lectureMaterialIncluded=False)
+startupTime = time.perf_counter() - startTime
+
+try:
+    import resource
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+except ImportError:
+    maxrss = None
+
+heavy = sorted(name for name in %r if name in sys.modules)
+print(json.dumps({"importTime": importTime, "startupTime": startupTime, "maxResidentBytes": maxrss, "heavyModules": heavy}))
+""" % heavyModules
+
+
+''' Measure the startup of the lightweight tutors in a fresh interpreter '''
+def measureStartup():
+    directory = os.path.dirname(os.path.abspath(__file__))
+    completed = subprocess.run([sys.executable, "-c", startupScript], cwd=directory, capture_output=True, text=True)
+    if completed.returncode != 0:
+        raise Exception("The startup script failed:\n" + completed.stderr)
+
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the startup time and memory of the no-KB and partial-KB tutors")
+    parser.add_argument("--budget", type=float, default=1.0, help="Seconds allowed to import Tutor and build both tutors")
+    parser.add_argument("--memory-budget", type=int, default=200, help="Maximum resident memory allowed, in MB")
+    parser.add_argument("--repeat", type=int, default=3, help="Fresh interpreters started; the fastest run is checked")
+    args = parser.parse_args()
+
+    runs = [measureStartup() for i in range(args.repeat)]
+    best = min(runs, key=lambda run: run["startupTime"])
+
+    failures = []
+    if best["startupTime"] > args.budget:
+        failures.append("startup took " + str(round(best["startupTime"], 3)) + "s (budget " + str(args.budget) + "s)")
+    if best["maxResidentBytes"] is not None and best["maxResidentBytes"] > args.memory_budget * 1024 * 1024:
+        failures.append("startup used " + str(best["maxResidentBytes"] // (1024 * 1024)) + " MB (budget " + str(args.memory_budget) + " MB)")
+    if best["heavyModules"]:
+        failures.append("heavy modules were imported: " + ", ".join(best["heavyModules"]))
+
+    print("import " + str(round(best["importTime"], 3)) + "s, startup " + str(round(best["startupTime"], 3)) + "s, " +
+          (str(best["maxResidentBytes"] // (1024 * 1024)) + " MB" if best["maxResidentBytes"] is not None else "memory unknown"))
+
+    if failures:
+        print("FAILED: " + "; ".join(failures))
+        sys.exit(1)
+
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
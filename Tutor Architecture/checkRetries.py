@@ -0,0 +1,88 @@
+import argparse
+import sys
+import time
+
+import openai
+
+from ChatClient import OpenAIClient
+from FakeOpenAIServer import FakeOpenAIServer
+
+
+''' Check of the OpenAIClient retries against a FakeOpenAIServer that fails the first requests: the retry count, that Retry-After hints are
+    honoured, that backoff without a hint stays within its exponential bound, and that the error is raised once the retries run out. Exits with
+    status 1 if a check fails. Example: python checkRetries.py '''
+
+
+class RecordingClient(OpenAIClient):
+    ''' An OpenAIClient that records every backoff delay it chooses '''
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.delays = []
+
+    def backoffDelay(self, attempt: int, error):
+        delay = super().backoffDelay(attempt, error)
+        self.delays.append(delay)
+        return delay
+
+
+''' Send one request through a client to a server failing its first failures requests. Returns (client, server stats, elapsed seconds, error). '''
+def runScenario(failures: int, failureStatus: int, retryAfter: float, maxRetries: int, baseDelay: float):
+    with FakeOpenAIServer(failures=failures, failureStatus=failureStatus, retryAfter=retryAfter) as server:
+        client = RecordingClient(rateLimits=dict(), apiBase=server.apiBase, maxRetries=maxRetries, baseDelay=baseDelay, maxDelay=10 * baseDelay)
+
+        error = None
+        startTime = time.perf_counter()
+        try:
+            client.create("gpt-4", [{"role": "user", "content": "Hello"}])
+        except openai.error.OpenAIError as e:
+            error = e
+        elapsed = time.perf_counter() - startTime
+
+        return client, server.stats(), elapsed, error
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the OpenAI client's retries and backoff against a failing local server")
+    parser.add_argument("--retry-after", type=float, default=0.2, help="Retry-After sent with the injected 429s, in seconds")
+    parser.add_argument("--base-delay", type=float, default=0.05, help="Backoff base delay of the client, in seconds")
+    args = parser.parse_args()
+
+    # openai requires a key even though the local server ignores it
+    openai.api_key = openai.api_key or "checkRetries"
+
+    failures = []
+    def check(condition: bool, message: str):
+        if not condition:
+            failures.append(message)
+
+    # 429 with Retry-After: every retry waits at least the hint
+    client, stats, elapsed, error = runScenario(failures=2, failureStatus=429, retryAfter=args.retry_after, maxRetries=3, baseDelay=args.base_delay)
+    check(error is None, "429 with Retry-After: the request failed: " + str(error))
+    check(client.retries == 2, "429 with Retry-After: " + str(client.retries) + " retries instead of 2")
+    check(stats["requests"] + stats["failed"] == 3, "429 with Retry-After: the server saw " + str(stats["requests"] + stats["failed"]) + " requests instead of 3")
+    check(all(delay >= args.retry_after for delay in client.delays), "429 with Retry-After: delays " + str(client.delays) + " are shorter than the hint")
+    check(elapsed >= 2 * args.retry_after, "429 with Retry-After: the retries took " + str(round(elapsed, 3)) + "s, less than the hints")
+    print("429 with Retry-After: " + str(client.retries) + " retries, delays " + ", ".join(str(round(delay, 3)) for delay in client.delays) + ", " + str(round(elapsed, 3)) + "s")
+
+    # 503 without a hint: full-jitter exponential backoff
+    client, stats, elapsed, error = runScenario(failures=3, failureStatus=503, retryAfter=None, maxRetries=3, baseDelay=args.base_delay)
+    check(error is None, "503: the request failed: " + str(error))
+    check(client.retries == 3, "503: " + str(client.retries) + " retries instead of 3")
+    check(all(0 <= delay <= args.base_delay * (2 ** attempt) for attempt, delay in enumerate(client.delays)), "503: delays " + str(client.delays) + " exceed the exponential bound")
+    print("503 without Retry-After: " + str(client.retries) + " retries, delays " + ", ".join(str(round(delay, 3)) for delay in client.delays))
+
+    # More failures than retries: the last error is raised
+    client, stats, elapsed, error = runScenario(failures=5, failureStatus=429, retryAfter=None, maxRetries=2, baseDelay=args.base_delay)
+    check(isinstance(error, openai.error.RateLimitError), "Retries exhausted: expected a RateLimitError, got " + repr(error))
+    check(client.retries == 2 and stats["failed"] == 3, "Retries exhausted: " + str(client.retries) + " retries and " + str(stats["failed"]) + " failed requests instead of 2 and 3")
+    print("Retries exhausted: " + type(error).__name__ + " after " + str(client.retries) + " retries")
+
+    if failures:
+        print("FAILED: " + "; ".join(failures))
+        sys.exit(1)
+
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
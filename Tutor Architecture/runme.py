@@ -1,5 +1,4 @@
 from Tutor import *
-import time
 
 # Obtain the OpenAI API key. Please place your Open AI API key in the './Tutor Architecture' directory in a file named API_KEY.txt for this to work. Or, just replace this code block with API_KEY = <your open AI API key>
 with open('API_KEY.txt', 'r') as file:
@@ -15,31 +14,40 @@ lessonSubject = "History of AI"
 questionBank = [{'q':'What characteristics are shared by both biological and artificial neurons? a) They both have dendrites b) Both can aggregate and process input values c) They both have axons d) Both can transmit outputs depending on certain criteria',
                  'a':'A, C: biological neurons have these properties and artificial neurons try to mimic them'}]
 
-# Define tutors
-tutorNoKB = Tutor(API_KEY = API_KEY, studentName = studentName, lessonSubject = lessonSubject, model = 4, topicsInformationIncluded=False, lectureMaterialIncluded=False)
-tutorPartialKB = Tutor(API_KEY = API_KEY, studentName = studentName, lessonSubject = lessonSubject, model = 4, topicsInformationIncluded=True, lectureMaterialIncluded=False)
+# Cache GPT responses on disk so that re-running this script does not repeat identical API requests
+responseCache = ResponseCache()
+
+# To see where the time goes, enable tracing: every stage is written to trace.jsonl and Prometheus metrics are served at http://127.0.0.1:9464/metrics
+# from Tracing import JsonLinesSpanExporter, PrometheusExporter; tracer.enable(JsonLinesSpanExporter("trace.jsonl"), PrometheusExporter().serve(9464))
+
+# Share one OpenAI client so the tutors share the per-model rate limits and a pool of keep-alive connections
+openAIClient = OpenAIClient()
 
+# Build the knowledge base once; all three tutors share it (each tutor only uses the parts its knowledge base depth allows)
 # Ensure docker is running, otherwise the Haystack instantiation will run into an error
-tutorWKB = Tutor(API_KEY = API_KEY, studentName = studentName, lessonSubject = lessonSubject, model = 4, topicsInformationIncluded=True, lectureMaterialIncluded=True)
+knowledgeBase = KnowledgeBase(API_KEY = API_KEY, lessonSubject = lessonSubject, model = 4, topicsInformationIncluded=True, lectureMaterialIncluded=True, responseCache=responseCache, openAIClient=openAIClient)
+
+# Define tutors
+tutorNoKB = Tutor(API_KEY = API_KEY, studentName = studentName, lessonSubject = lessonSubject, model = 4, topicsInformationIncluded=False, lectureMaterialIncluded=False, responseCache=responseCache, knowledgeBase=knowledgeBase, openAIClient=openAIClient)
+tutorPartialKB = Tutor(API_KEY = API_KEY, studentName = studentName, lessonSubject = lessonSubject, model = 4, topicsInformationIncluded=True, lectureMaterialIncluded=False, responseCache=responseCache, knowledgeBase=knowledgeBase, openAIClient=openAIClient)
+tutorWKB = Tutor(API_KEY = API_KEY, studentName = studentName, lessonSubject = lessonSubject, model = 4, topicsInformationIncluded=True, lectureMaterialIncluded=True, responseCache=responseCache, knowledgeBase=knowledgeBase, openAIClient=openAIClient)
+
+# Assess every question & answer with all three tutors concurrently. Results are also saved to evaluationResults.jsonl as they complete
+tutors = {"Without KB": tutorNoKB, "Partial KB": tutorPartialKB, "Full KB": tutorWKB}
+results = evaluateTutors(tutors, questionBank, maxWorkers=3, outputPath="evaluationResults.jsonl")
 
-# Iterate through questions & answers, then assess them
 for i in range(len(questionBank)):
-    time.sleep(15)
     print("\n\nNew Question: ")
     question = questionBank[i]["q"]
     answer = questionBank[i]["a"]
 
     print("Question:",question)
     print("Answer:",answer)
-    print("\n")
-
-    print("Without KB:")
-    tutorNoKB.answerRating(question,answer)
-
-
-    print("\nPartial KB")
-    tutorPartialKB.answerRating(question,answer)
-
 
-    print("\nFull KB:")
-    tutorWKB.answerRating(question,answer)
+    for name in tutors:
+        result = results[name][i]
+        print("\n" + name + ":")
+        if "error" in result:
+            print("Error: " + result["error"])
+        else:
+            print("Athena: " + result["feedback"])